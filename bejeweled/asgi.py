@@ -1,14 +1,17 @@
 import os
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bejeweled.settings')
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
+from game.affinity import RoomHostMiddleware
+from game.auth import CachedAuthMiddlewareStack
 from game.urls import websocket_urlpatterns
-from channels.auth import AuthMiddlewareStack
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'game.settings')
 
-application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+application = RoomHostMiddleware(ProtocolTypeRouter({
+    "http": django_asgi_app,
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter(websocket_urlpatterns)
     ),
-})
+}))
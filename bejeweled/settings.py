@@ -74,24 +74,91 @@ TEMPLATES = [
 WSGI_APPLICATION = 'bejeweled.wsgi.application'
 ASGI_APPLICATION = "bejeweled.asgi.application"
 
-# Redis backend for Django Channels
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",  # Change to Redis in production
-    },
-}
+# Channel layer for Django Channels. The in-memory layer only reaches clients
+# of one process; set REDIS_URL (needs channels_redis) or GAME_BROKER_SOCKET
+# (the local broker from `manage.py run_broker`) to run several workers.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+GAME_BROKER_SOCKET = os.environ.get("GAME_BROKER_SOCKET", "")
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        },
+    }
+elif GAME_BROKER_SOCKET:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "game.layers.BrokerChannelLayer",
+            "CONFIG": {"path": GAME_BROKER_SOCKET},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Room affinity: each room's state lives on one of GAME_WORKERS (comma
+# separated ids), chosen by hashing the room name. Every worker needs its own
+# GAME_WORKER_ID and a shared channel layer. Leave unset for a single process.
+GAME_WORKER_ID = os.environ.get("GAME_WORKER_ID", "")
+GAME_WORKERS = [w for w in os.environ.get("GAME_WORKERS", "").split(",") if w]
+
+# Stage timings and counters for the game, served at /metrics/ in the
+# Prometheus text format. Off unless GAME_METRICS is set to a non-zero value.
+GAME_METRICS = os.environ.get("GAME_METRICS", "0") not in ("", "0")
 
 
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# GAME_DB picks the backend. "sqlite" (the default) runs in WAL mode so reads
+# don't wait on writes, with a busy timeout and immediate write transactions.
+# "postgres" (needs psycopg[pool]) reads POSTGRES_* and keeps a connection
+# pool of up to POSTGRES_POOL_SIZE.
+GAME_DB = os.environ.get("GAME_DB", "sqlite")
+
+if GAME_DB == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("POSTGRES_DB", "bejeweled"),
+            'USER': os.environ.get("POSTGRES_USER", "bejeweled"),
+            'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ""),
+            'HOST': os.environ.get("POSTGRES_HOST", "localhost"),
+            'PORT': os.environ.get("POSTGRES_PORT", "5432"),
+            # The pool keeps connections open; Django's own persistence must be off with it
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {'min_size': 2, 'max_size': int(os.environ.get("POSTGRES_POOL_SIZE", "10"))},
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # Keep connections, so the PRAGMAs run once per thread
+            'CONN_MAX_AGE': None,
+            'OPTIONS': {
+                # Seconds a connection waits for the write lock before failing
+                'timeout': 20,
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            },
+        }
     }
-}
+
+# Game writes (room flushes, move logs, score commits) go through one
+# dedicated writer thread that commits whatever has queued up in a single
+# transaction. On by default for SQLite, which allows one writer anyway; with
+# Postgres they run like any other query, each in its own transaction.
+GAME_DB_WRITER = os.environ.get("GAME_DB_WRITER", "1" if GAME_DB == "sqlite" else "0") not in ("", "0")
 
 
 # Password validation
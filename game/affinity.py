@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import sys
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .metrics import metrics
+from .protocol import board_payload
+from .rooms import board_id_for, play_move, rooms
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker waits for a room's owner to answer
+CALL_TIMEOUT = 5.0
+
+
+def worker_id():
+    return getattr(settings, 'GAME_WORKER_ID', '') or f'{socket.gethostname()}-{os.getpid()}'
+
+
+def owner_of(name):
+    """The worker that holds a room's authoritative state.
+
+    Rooms are spread over settings.GAME_WORKERS by rendezvous hashing, so
+    every worker agrees on the owner without coordinating. With no workers
+    configured every room is local.
+    """
+    workers = getattr(settings, 'GAME_WORKERS', None)
+    if not workers:
+        return worker_id()
+    return max(workers, key=lambda w: hashlib.blake2b(f'{w}:{name}'.encode(), digest_size=8).digest())
+
+
+def inbox_for(worker):
+    return f'game-rooms.{worker}'
+
+
+class LocalRoom:
+    """Handle on a room owned by this worker."""
+
+    def __init__(self, room, protocol=None):
+        self.room = room
+        self.protocol = protocol
+        self.name = room.name
+        self.board_id = room.board_id
+
+    async def snapshot(self, protocol, rejected=False):
+        return board_payload(protocol, self.room, rejected)
+
+    async def move(self, x1, y1, x2, y2, player_id, protocol, version=None):
+        # Moves that can't apply are turned away before queueing; the rest run
+        # one at a time on the room's worker, which checks them again
+        reason = self.room.check_move(x1, y1, x2, y2, version)
+        if reason is not None:
+            metrics.inc('moves_total', result=reason)
+            return reason
+        return await self.room.submit(play_move, self.room, x1, y1, x2, y2, player_id, protocol, version)
+
+    async def close(self):
+        await rooms.leave(self.room, self.protocol)
+
+
+class RemoteRoom:
+    """Handle on a room owned by another worker, reached over the channel layer."""
+
+    def __init__(self, name, owner, protocol=None):
+        self.name = name
+        self.owner = owner
+        self.protocol = protocol
+        self.board_id = board_id_for(name)
+
+    async def snapshot(self, protocol, rejected=False):
+        return await host.call(self.owner, 'snapshot', name=self.name, protocol=protocol, rejected=rejected)
+
+    async def move(self, x1, y1, x2, y2, player_id, protocol, version=None):
+        return await host.call(
+            self.owner, 'move', name=self.name, x1=x1, y1=y1, x2=x2, y2=y2,
+            player_id=player_id, protocol=protocol, version=version,
+        )
+
+    async def close(self):
+        await host.call(self.owner, 'leave', name=self.name, protocol=self.protocol)
+
+
+async def open_room(name, protocol=None):
+    """Joins a room on whichever worker owns it and returns a handle to it.
+
+    ``protocol`` is the one the client speaks; the room encodes its moves for
+    the protocols its clients use.
+    """
+    owner = owner_of(name)
+    if owner == worker_id():
+        return LocalRoom(await rooms.join(name, protocol), protocol)
+    await host.call(owner, 'join', name=name, protocol=protocol)
+    return RemoteRoom(name, owner, protocol)
+
+
+class RoomHost:
+    """Serves calls from other workers for the rooms this worker owns.
+
+    Each worker listens on its own inbox channel; replies come back on a
+    channel private to the calling worker and resolve the waiting call.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = []
+        self._reply_channel = None
+        self._starting = None
+
+    async def start(self):
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._starting)
+
+    async def _start(self):
+        layer = get_channel_layer()
+        self._reply_channel = await layer.new_channel('game-rooms-reply.')
+        self._tasks = [
+            asyncio.ensure_future(self._serve(layer, inbox_for(worker_id()))),
+            asyncio.ensure_future(self._collect(layer)),
+        ]
+
+    async def call(self, owner, op, **args):
+        await self.start()
+        call_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        try:
+            await get_channel_layer().send(inbox_for(owner), {
+                'type': 'room.call',
+                'id': call_id,
+                'op': op,
+                'args': args,
+                'reply_to': self._reply_channel,
+            })
+            return await asyncio.wait_for(future, CALL_TIMEOUT)
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def _serve(self, layer, inbox):
+        while True:
+            message = await layer.receive(inbox)
+            # Moves still queue on the room's own worker, so calls can overlap
+            asyncio.ensure_future(self._handle(layer, message))
+
+    async def _handle(self, layer, message):
+        reply = {'type': 'room.reply', 'id': message['id']}
+        try:
+            reply['result'] = await self._dispatch(message['op'], **message['args'])
+        except Exception as exc:
+            logger.exception("Room call %s failed", message['op'])
+            reply['error'] = str(exc)
+        await layer.send(message['reply_to'], reply)
+
+    async def _dispatch(self, op, name, **args):
+        if op == 'join':
+            await rooms.join(name, args.get('protocol'))
+            return None
+        room = rooms.rooms.get(name)
+        if room is None:
+            raise LookupError(f"Room {name} is not open on this worker")
+        if op == 'leave':
+            await rooms.leave(room, args.get('protocol'))
+            return None
+        if op == 'snapshot':
+            return board_payload(args['protocol'], room, args['rejected'])
+        if op == 'move':
+            return await LocalRoom(room).move(**args)
+        raise ValueError(f"Unknown room call {op}")
+
+    async def _collect(self, layer):
+        while True:
+            reply = await layer.receive(self._reply_channel)
+            future = self._calls.get(reply['id'])
+            if future is None or future.done():
+                continue
+            if 'error' in reply:
+                future.set_exception(RuntimeError(reply['error']))
+            else:
+                future.set_result(reply['result'])
+
+
+host = RoomHost()
+
+
+class RoomHostMiddleware:
+    """Starts this worker's RoomHost at server startup when rooms are sharded.
+
+    Other workers may call in before this one sees any traffic, so the host
+    starts on the lifespan startup event, or once Daphne's reactor is running
+    since Daphne sends no lifespan events. The first connection starts it
+    otherwise.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = bool(getattr(settings, 'GAME_WORKERS', None))
+        if self.enabled and 'twisted.internet.reactor' in sys.modules:
+            from twisted.internet import reactor
+            reactor.callWhenRunning(lambda: asyncio.ensure_future(host.start()))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if self.enabled and scope['type'] in ('http', 'websocket'):
+            await host.start()
+        return await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.enabled:
+                    await host.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,84 @@
+import time
+
+from channels.auth import AuthMiddleware, get_user
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, user_logged_out
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+# Seconds a signed-in user is reused for connections from the same session
+# without reading the user again. The session itself is read every time, so
+# a logout anywhere takes effect at once; a password change made in another
+# process can go unseen for this long.
+AUTH_CACHE_TTL = 60.0
+# Entries held before expired ones are swept
+AUTH_CACHE_SIZE = 10000
+
+# session key -> (user, session auth hash, expiry)
+_users = {}
+
+
+def forget_session(session_key):
+    """Drops a cached session, e.g. on logout, so this process reads it afresh."""
+    _users.pop(session_key, None)
+
+
+def forget_user(user_id):
+    """Drops every cached session of a user."""
+    for key in [key for key, (user, _, _) in _users.items() if user.pk == user_id]:
+        del _users[key]
+
+
+@receiver(user_logged_out)
+def _logged_out(sender, request=None, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None:
+        forget_session(session.session_key)
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, **kwargs):
+    # A password change ends the user's other sessions, so they are checked afresh
+    forget_user(instance.pk)
+
+
+@database_sync_to_async
+def _session_user(session):
+    return session.get(SESSION_KEY), session.get(HASH_SESSION_KEY)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """Channels' AuthMiddleware with signed-in users cached by session key.
+
+    A reconnect within AUTH_CACHE_TTL still reads its session, but skips
+    reading the user when the session names the same user and auth hash
+    as when it was cached. Anonymous sessions are never cached, so signing
+    in takes effect at once.
+    """
+
+    async def resolve_scope(self, scope):
+        session = scope["session"]
+        key = session.session_key
+        now = time.monotonic()
+        cached = _users.get(key) if key else None
+        if cached is not None and cached[2] > now:
+            user, auth_hash, _ = cached
+            if await _session_user(session) == (str(user.pk), auth_hash):
+                scope["user"]._wrapped = user
+                return
+            forget_session(key)
+        user = await get_user(scope)
+        if key and user.is_authenticated:
+            if len(_users) >= AUTH_CACHE_SIZE:
+                for stale in [k for k, (_, _, expiry) in _users.items() if expiry <= now]:
+                    del _users[stale]
+                if len(_users) >= AUTH_CACHE_SIZE:
+                    _users.clear()
+            _users[key] = (user, user.get_session_auth_hash(), now + AUTH_CACHE_TTL)
+        scope["user"]._wrapped = user
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
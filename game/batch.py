@@ -0,0 +1,198 @@
+"""Vectorized evaluation of many boards at once, for analytics and bulk simulation.
+
+Boards are an ``(N, height, width)`` uint8 array using the engine's cell
+codes: 0 is empty and 1..len(GEM_TYPES) are gems. Results match the
+reference consumer logic (game/reference.py) and the engine board for board.
+NumPy is an optional dependency needed only here.
+"""
+from .engine import GEM_TYPES, Board
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("The batch engine needs NumPy; install it with `pip install numpy`")
+
+
+def stack(boards):
+    """Packs engine Boards of one size into an (N, height, width) array."""
+    _require_numpy()
+    height, width = boards[0].height, boards[0].width
+    return np.array([np.frombuffer(bytes(b.cells), dtype=np.uint8) for b in boards]).reshape(-1, height, width)
+
+
+def unstack(boards):
+    """Turns an (N, height, width) array back into engine Boards."""
+    _, height, width = boards.shape
+    return [Board(width, height, board.tobytes()) for board in boards]
+
+
+def random_boards(n, height=8, width=8, rng=None):
+    """Boards of uniformly random gems, which may hold runs or have no moves."""
+    _require_numpy()
+    rng = rng if rng is not None else np.random.default_rng()
+    return rng.integers(1, len(GEM_TYPES) + 1, size=(n, height, width), dtype=np.uint8)
+
+
+def match_mask(boards):
+    """Marks every cell in a horizontal or vertical run of three or more."""
+    mask = np.zeros(boards.shape, dtype=bool)
+    a = boards[:, :, :-2]
+    run = (a != 0) & (a == boards[:, :, 1:-1]) & (a == boards[:, :, 2:])
+    mask[:, :, :-2] |= run
+    mask[:, :, 1:-1] |= run
+    mask[:, :, 2:] |= run
+    a = boards[:, :-2, :]
+    run = (a != 0) & (a == boards[:, 1:-1, :]) & (a == boards[:, 2:, :])
+    mask[:, :-2, :] |= run
+    mask[:, 1:-1, :] |= run
+    mask[:, 2:, :] |= run
+    return mask
+
+
+def has_matches(boards):
+    return match_mask(boards).any(axis=(1, 2))
+
+
+def _lands_in_run(padded, gem, at, came_from, shape):
+    """Whether ``gem``, moved to offset ``at`` of each swap, lines up a run there.
+
+    ``came_from`` is the unit step back to the cell it left, which now holds
+    the other gem, so only the far side is checked along the swap. Offsets
+    are relative to each swap's first cell in a board padded by two empties.
+    """
+    h, w = shape
+    (ty, tx), (dy, dx) = at, came_from
+
+    def near(oy, ox):
+        return padded[:, 2 + ty + oy:2 + ty + oy + h, 2 + tx + ox:2 + tx + ox + w] == gem
+
+    along = near(-dy, -dx) & near(-2 * dy, -2 * dx)
+    py, px = dx, dy
+    before, after = near(-py, -px), near(py, px)
+    across = (before & near(-2 * py, -2 * px)) | (before & after) | (after & near(2 * py, 2 * px))
+    return (gem != 0) & (along | across)
+
+
+def move_masks(boards):
+    """Which swaps make a match: (right, down) masks of shape (N, H, W-1) and (N, H-1, W).
+
+    ``right[n, y, x]`` covers swapping (x, y) with (x + 1, y), and ``down``
+    swapping (x, y) with (x, y + 1). Like Board.is_move, swapping equal gems
+    never counts.
+    """
+    padded = np.pad(boards, ((0, 0), (2, 2), (2, 2)))
+    _, height, width = boards.shape
+
+    a, b = boards[:, :, :-1], boards[:, :, 1:]
+    shape = (height, width - 1)
+    right = (a != b) & (
+        _lands_in_run(padded, a, (0, 1), (0, -1), shape) | _lands_in_run(padded, b, (0, 0), (0, 1), shape)
+    )
+    a, b = boards[:, :-1, :], boards[:, 1:, :]
+    shape = (height - 1, width)
+    down = (a != b) & (
+        _lands_in_run(padded, a, (1, 0), (-1, 0), shape) | _lands_in_run(padded, b, (0, 0), (1, 0), shape)
+    )
+    return right, down
+
+
+def move_counts(boards):
+    right, down = move_masks(boards)
+    return right.sum(axis=(1, 2)) + down.sum(axis=(1, 2))
+
+
+def has_valid_moves(boards):
+    """Like the consumer's check: a board with a run already counts as playable."""
+    right, down = move_masks(boards)
+    return has_matches(boards) | right.any(axis=(1, 2)) | down.any(axis=(1, 2))
+
+
+def collapse(boards):
+    """Drops every gem to the bottom of its column, keeping their order."""
+    order = np.argsort(boards != 0, axis=1, kind="stable")
+    return np.take_along_axis(boards, order, axis=1)
+
+
+def refill(boards, rng):
+    """Fills every empty cell with a random gem, in place."""
+    empty = boards == 0
+    boards[empty] = rng.integers(1, len(GEM_TYPES) + 1, size=int(empty.sum()), dtype=np.uint8)
+    return boards
+
+
+def cascade(boards, rng):
+    """Clears runs, drops and refills until every board is stable.
+
+    Returns the stable boards and an (N, levels) array of the gems cleared
+    at each cascade level.
+    """
+    boards = boards.copy()
+    levels = []
+    active = np.arange(len(boards))
+    while len(active):
+        sub = boards[active]
+        mask = match_mask(sub)
+        cleared = mask.sum(axis=(1, 2))
+        matched = cleared > 0
+        if not matched.any():
+            break
+        active, sub, mask = active[matched], sub[matched], mask[matched]
+        level = np.zeros(len(boards), dtype=np.int64)
+        level[active] = cleared[matched]
+        levels.append(level)
+        sub[mask] = 0
+        boards[active] = refill(collapse(sub), rng)
+    if not levels:
+        return boards, np.zeros((len(boards), 0), dtype=np.int64)
+    return boards, np.stack(levels, axis=1)
+
+
+def cascade_points(levels):
+    """Points per board for an (N, levels) cleared array, as scores.cascade_points scores one."""
+    combo = 1.0 + 0.5 * np.arange(levels.shape[1])
+    size = np.where(levels > 4, 2.0, np.where(levels > 3, 1.5, 1.0))
+    return np.floor(levels * 10 * size * combo).astype(np.int64).sum(axis=1)
+
+
+def generate(n, height=8, width=8, rng=None):
+    """Random boards with no runs and at least one legal move."""
+    _require_numpy()
+    rng = rng if rng is not None else np.random.default_rng()
+    boards, _ = cascade(random_boards(n, height, width, rng), rng)
+    while True:
+        stuck = ~has_valid_moves(boards)
+        if not stuck.any():
+            return boards
+        boards[stuck], _ = cascade(random_boards(int(stuck.sum()), height, width, rng), rng)
+
+
+def random_moves(boards, rng):
+    """Picks one legal swap per board at random as (y1, x1, y2, x2) arrays.
+
+    Every board needs at least one legal move.
+    """
+    right, down = move_masks(boards)
+    n = len(boards)
+    legal = np.concatenate([right.reshape(n, -1), down.reshape(n, -1)], axis=1)
+    choice = np.argmax(rng.random(legal.shape) * legal, axis=1)
+    _, height, width = boards.shape
+    horizontal = choice < height * (width - 1)
+    y1 = np.where(horizontal, choice // (width - 1), (choice - height * (width - 1)) // width)
+    x1 = np.where(horizontal, choice % (width - 1), (choice - height * (width - 1)) % width)
+    y2 = np.where(horizontal, y1, y1 + 1)
+    x2 = np.where(horizontal, x1 + 1, x1)
+    return y1, x1, y2, x2
+
+
+def swap(boards, y1, x1, y2, x2):
+    """Swaps one pair of cells on every board, in place."""
+    n = np.arange(len(boards))
+    first = boards[n, y1, x1]
+    boards[n, y1, x1] = boards[n, y2, x2]
+    boards[n, y2, x2] = first
+    return boards
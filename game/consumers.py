@@ -1,278 +1,244 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from asgiref.sync import sync_to_async
-from .models import GameBoard, GamePlayer
-from django.contrib.auth.models import User
+from .affinity import open_room
+from .leaderboard import leaderboard, leaderboard_group
+from .metrics import metrics
+from .protocol import PROTOCOLS, decode_client_binary, encode
+from .rooms import DEFAULT_ROOM, client_lag, group_name
+from .scores import cascade_points, scores
+import asyncio
 import uuid
-import random
 import json
-from channels.layers import get_channel_layer
-import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
 
-GEM_TYPES = ["red", "blue", "green", "yellow", "purple", "orange", "white"]
+# Most versions a client may be past the one it last acknowledged; further
+# behind, one snapshot replaces the frames it has yet to get
+MAX_BACKLOG = 10
+# Messages a connection may send per second, and in one burst, before the
+# excess is dropped unread
+MESSAGE_RATE = 10
+MESSAGE_BURST = 20
 
 class GameConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_name = 'game_room'
-        self.room_group_name = f'game_{self.room_name}'
+        self.room_name = self.scope.get('url_route', {}).get('kwargs', {}).get('room_id', DEFAULT_ROOM)
+        self.room_group_name = group_name(self.room_name)
         self.player_id = str(uuid.uuid4())
         self.score = 0
         self.combo_multiplier = 1.0
+        # Broadcasts at or below this version are covered by a snapshot already sent
+        self.synced_version = -1
+        # The room's latest version as far as this connection knows, the latest
+        # the client says it has applied, and whether broadcasts are held back
+        # until it has applied the last snapshot
+        self.latest = -1
+        self.acked = -1
+        self.holding = False
+        self.lag = client_lag[self.channel_name] = {'room': self.room_name, 'lag': 0, 'max_lag': 0, 'dropped': 0}
+        self.tokens = MESSAGE_BURST
+        self.tokens_at = time.monotonic()
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.protocol = query.get('mode', ['json'])[0]
+        if self.protocol not in PROTOCOLS:
+            self.protocol = 'json'
 
         self.user = self.scope["user"]
-        print(self.user)
-        if self.user.is_authenticated:
-            self.game_player = await self.get_or_create_game_player()
-            self.score = await self.get_player_score()
-        else:
-            self.score = 0
-        
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
-        
-        self.board = await self.get_board_from_db()
-        await self.send_board()
+
+        # The room (in memory while it's live or recently left), the player's
+        # score and, on a worker's first connection, the leaderboard load side
+        # by side, then the snapshot goes out at once
+        with metrics.timer('connect'):
+            self.room, self.score, _ = await asyncio.gather(
+                open_room(self.room_name, self.protocol), self.load_score(), self.load_leaderboard(),
+            )
+            try:
+                await asyncio.gather(
+                    self.channel_layer.group_add(self.room_group_name, self.channel_name),
+                    self.channel_layer.group_add(leaderboard_group(), self.channel_name),
+                )
+            except BaseException:
+                # Leave the room again, or it would count a client forever
+                room, self.room = self.room, None
+                await room.close()
+                raise
+            await self.accept()
+            await self.send_board()
+            # The client starts from this snapshot; how far it gets behind
+            # is counted from here until it acknowledges a version
+            self.acked = self.synced_version
+        metrics.inc('connections_total')
 
     async def disconnect(self, close_code):
+        client_lag.pop(self.channel_name, None)
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_discard(leaderboard_group(), self.channel_name)
+        if getattr(self, 'room', None) is not None:
+            await self.room.close()
+        if self.user.is_authenticated:
+            await scores.release(self.user.id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None:
+                data = decode_client_binary(bytes_data)
+            else:
+                data = json.loads(text_data)
+            if not isinstance(data, dict):
+                raise ValueError("Message is not an object")
+        except ValueError:
+            # Unreadable messages are answered below as illegal moves, after
+            # spending a token like any other message
+            data = {}
+        if data.get("type") == "ack":
+            # Acknowledgements cost no tokens; they only move a number
+            await self.acknowledge(data.get("v"))
+            return
+        resync = data.get("type") == "resync"
+        # Clients may number their moves; the number is echoed in the reply
+        seq = data.get("seq")
+        if not isinstance(seq, int):
+            seq = None
+        if not self.take_token():
+            # Over the limit: answer moves without asking the room so the
+            # client can undo its optimistic swap, and ignore resyncs
+            if not resync:
+                metrics.inc('moves_total', result='rate_limited')
+                await self.send_frame(encode(self.protocol, {"rejected": True, "reason": "rate_limited", "seq": seq}))
+            return
+        if resync:
+            await self.send_board()
+            return
+        try:
+            x1, y1, x2, y2 = int(data["x1"]), int(data["y1"]), int(data["x2"]), int(data["y2"])
+            # Clients may say which board version they moved on; moves made on
+            # an older board are rejected as stale
+            version = data.get("v")
+            if version is not None:
+                version = int(version)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            metrics.inc('moves_total', result='illegal')
+            await self.send_board(rejected='illegal', seq=seq)
+            return
+        if version is not None:
+            # A move made on a version shows the client has applied it
+            await self.acknowledge(version)
+
+        result = await self.room.move(x1, y1, x2, y2, self.player_id, self.protocol, version)
+        if isinstance(result, str):
+            await self.send_board(rejected=result, seq=seq)
+            return
+
+        mover_frame, cleared = result
+        self.score_cascade(cleared)
+        mover_frame['score'] = self.score
+        mover_frame['combo_multiplier'] = self.combo_multiplier
+        if seq is not None:
+            mover_frame['seq'] = seq
+        await self.send_frame(encode(self.protocol, mover_frame, mine=True))
+
+    async def acknowledge(self, version):
+        """Records the latest version the client has applied.
+
+        Clients acknowledge the versions they apply, and each move's ``v``
+        counts as one. Broadcasts held back behind a snapshot resume once the
+        client has applied it, with a fresh snapshot if the room moved on.
+        """
+        if not isinstance(version, int) or version <= self.acked:
+            return
+        self.acked = version
+        self.lag['lag'] = max(0, self.latest - version)
+        if self.holding and version >= self.synced_version:
+            self.holding = False
+            if self.latest > self.synced_version:
+                await self.send_board()
+
+    def take_token(self):
+        """Spends one of the connection's message tokens, refilled at MESSAGE_RATE a second."""
+        now = time.monotonic()
+        self.tokens = min(MESSAGE_BURST, self.tokens + (now - self.tokens_at) * MESSAGE_RATE)
+        self.tokens_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        x1, y1, x2, y2 = int(data["x1"]), int(data["y1"]), int(data["x2"]), int(data["y2"])
-        
-        board_lock = asyncio.Lock()
-        async with board_lock:
-            self.board = await self.get_board_from_db()
-            
-            if self.is_valid_swap(x1, y1, x2, y2):
-                self.swap_gems(x1, y1, x2, y2)
-                if not self.has_valid_moves():
-                    await self.shuffle_board()
-                matches = self.find_matches()
-                if matches:
-                    await self.process_matches()
-                    await self.save_board_to_db()
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'broadcast_move',
-                            'board': self.board,
-                            'player_id': self.player_id,
-                            'score': self.score
-                        }
-                    )
-                else:
-                    self.swap_gems(x1, y1, x2, y2)  # Swap back if no matches
-                    await self.send_board()
-
-    def find_matches(self):
-        matched = set()
-        
-        # Check horizontal matches
-        for y in range(8):
-            for x in range(6):
-                if self.board[y][x] and self.board[y][x] == self.board[y][x + 1] == self.board[y][x + 2]:
-                    matched |= {(y, x), (y, x + 1), (y, x + 2)}
-        
-        # Check vertical matches
-        for y in range(6):
-            for x in range(8):
-                if self.board[y][x] and self.board[y][x] == self.board[y + 1][x] == self.board[y + 2][x]:
-                    matched |= {(y, x), (y + 1, x), (y + 2, x)}
-        
-        return matched
-
-    @database_sync_to_async
-    def get_player_score(self):
-        return self.game_player.score
-
-    @database_sync_to_async
-    def update_player_score(self, points):
-        self.game_player.update_score(points)
-        self.game_player.save()  # Make sure to save the changes
-        return self.game_player.score
-
-    @database_sync_to_async
-    def get_or_create_game_player(self):
-        game_player, created = GamePlayer.objects.get_or_create(user=self.user)
-        return game_player
-
+    async def load_leaderboard(self):
+        # Score commits only move a loaded leaderboard, and pushes only carry
+        # ranks from one, so every worker serving sockets loads it
+        try:
+            await leaderboard.ready()
+        except Exception:
+            logger.exception("Failed to load the leaderboard")
 
-    async def update_score(self, matches):
+    async def load_score(self):
         if not self.user.is_authenticated:
             return 0
-            
-        points_per_gem = 10
-        size_multiplier = 1.0
-        if len(matches) > 3:
-            size_multiplier = 1.5
-        if len(matches) > 4:
-            size_multiplier = 2.0
-            
-        points = int(len(matches) * points_per_gem * size_multiplier * self.combo_multiplier)
-        
-        # Update score in database
-        self.score = await self.update_player_score(points)
+        return await scores.join(self.user.id)
+
+    def score_cascade(self, cleared):
+        # Points are added in memory and written in one batch by the score buffer
+        with metrics.timer('scoring'):
+            points, self.combo_multiplier = cascade_points(cleared)
+            if self.user.is_authenticated:
+                self.score = scores.add(self.user.id, points)
         return points
 
-
-    def clear_matches(self, matches):
-        if not matches:
-            return False
-        
-        for y, x in matches:
-            self.board[y][x] = None
-
-        return True  # Removed score update from here as it's now handled in update_score
-
-
-    def has_valid_moves(self):
-        # Checks if any valid swap exists that results in a match.
-        for y in range(8):
-            for x in range(8):
-                # Try swapping right
-                if x < 7:
-                    self.swap_gems(x, y, x + 1, y)
-                    if self.find_matches():
-                        self.swap_gems(x, y, x + 1, y)  # Swap back
-                        return True
-                    self.swap_gems(x, y, x + 1, y)  # Swap back
-                
-                # Try swapping down
-                if y < 7:
-                    self.swap_gems(x, y, x, y + 1)
-                    if self.find_matches():
-                        self.swap_gems(x, y, x, y + 1)  # Swap back
-                        return True
-                    self.swap_gems(x, y, x, y + 1)  # Swap back
-
-        return False  # No valid moves left
-
-    async def shuffle_board(self):
-        # Shuffles the board while ensuring at least one valid move exists.
-        while True:
-            # Generate a new random board
-            self.board = [[random.choice(GEM_TYPES) for _ in range(8)] for _ in range(8)]
-
-            # Ensure the shuffled board has at least one valid move
-            if self.has_valid_moves():
-                break  # Exit loop when a playable board is found
-
-        await self.save_board_to_db()
-        await self.send_board_to_group()
-
-
-    async def process_matches(self, is_combo=False):
-        matches = self.find_matches()
-        if not matches:
-            return False
-        
-        if not is_combo:
-            self.combo_multiplier = 1.0
-        
-        # Calculate and update score
-        points = await self.update_score(matches)
-        self.score = await self.get_player_score()  # Update local score after DB update
-        
-        self.clear_matches(matches)
-        await self.animate_gravity()
-        
-        new_matches = self.find_matches()
-        if new_matches:
-            self.combo_multiplier += 0.5
-            await self.process_matches(is_combo=True)
-        
-        return True
-
-    async def animate_gravity(self, speed=0.15, max_depth=40):
-        falling = True
-        if max_depth <= 0:
-            return  # Avoid infinite recursion by stopping after max_depth.
-        while falling:
-            falling = False
-            for y in range(6, -1, -1):
-                for x in range(8):
-                    if self.board[y][x] and self.board[y + 1][x] is None:
-                        self.board[y + 1][x] = self.board[y][x]
-                        self.board[y][x] = None
-                        falling = True
-            await self.send_board()
-            await self.send_board_to_group()
-            await asyncio.sleep(speed)
-
-        need_refill = False
-        for x in range(8):
-            if self.board[0][x] is None:
-                self.board[0][x] = random.choice(GEM_TYPES)
-                need_refill = True
-        
-        if need_refill:
-            await self.animate_gravity(speed=speed/1.2, max_depth=max_depth-1)
-
-        matches = self.find_matches()
-        if not self.has_valid_moves():
-            await self.shuffle_board()
-
-        print(matches)
-        if matches:
-            print("Clearing")
-            self.clear_matches(matches)
-            await self.animate_gravity(speed=speed/1.2, max_depth=max_depth-1)
-
-    def is_valid_swap(self, x1, y1, x2, y2):
-        return abs(x1 - x2) + abs(y1 - y2) == 1
-
-    def swap_gems(self, x1, y1, x2, y2):
-        self.board[y1][x1], self.board[y2][x2] = self.board[y2][x2], self.board[y1][x1]
-
-    @sync_to_async
-    def get_board_from_db(self):
-        game_board_id = uuid.UUID('f47ac10b-58cc-4372-a567-0e02b2c3d479')
-        game_board, created = GameBoard.objects.get_or_create(id=game_board_id)
-        if created or not game_board.board_state:
-            game_board.board_state = [[random.choice(GEM_TYPES) for _ in range(8)] for _ in range(8)]
-            game_board.save()
-        return game_board.board_state
-
-    @sync_to_async
-    def save_board_to_db(self):
-        game_board_id = uuid.UUID('f47ac10b-58cc-4372-a567-0e02b2c3d479')
-        game_board = GameBoard.objects.get(id=game_board_id)
-        game_board.board_state = self.board
-        game_board.save()
-
-    @database_sync_to_async
-    def get_score_from_db(self):
-        game_board = GameBoard.objects.get(id=uuid.UUID('f47ac10b-58cc-4372-a567-0e02b2c3d479'))
-        return game_board.score or 0
-
-    @database_sync_to_async
-    def save_score_to_db(self):
-        game_board = GameBoard.objects.get(id=uuid.UUID('f47ac10b-58cc-4372-a567-0e02b2c3d479'))
-        game_board.score = self.score
-        game_board.save()
-
-    async def send_board(self):
-        await self.send(text_data=json.dumps({
-            "board": self.board,
+    async def send_board(self, rejected=None, seq=None):
+        # ``rejected`` is the reason a move was turned away, if one was
+        payload = await self.room.snapshot(self.protocol, bool(rejected))
+        payload.update({
             "player_id": self.player_id,
             "score": self.score
-        }))
-
-    async def send_board_to_group(self):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'broadcast_move',
-                'board': self.board,
-                'player_id': self.player_id,
-                
-            }
-        )
-
-    async def broadcast_move(self, event):
-        if event['player_id'] != self.player_id:
-            await self.send(text_data=json.dumps({
-                "board": event['board'],
-                "player_id": event['player_id'],
-            }))
+        })
+        if rejected:
+            payload["rejected"] = True
+            payload["reason"] = rejected
+        else:
+            self.synced_version = payload.get("v", payload.get("version"))
+            self.latest = max(self.latest, self.synced_version)
+        if seq is not None:
+            payload["seq"] = seq
+        await self.send_frame(encode(self.protocol, payload))
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def broadcast_moves(self, event):
+        # One message per room tick, carrying a frame per protocol for all its moves
+        version = event['version']
+        self.latest = max(self.latest, version)
+        lag = self.lag['lag'] = max(0, version - self.acked)
+        self.lag['max_lag'] = max(self.lag['max_lag'], lag)
+        if version <= self.synced_version or event['players'] == [self.player_id]:
+            # Covered by a snapshot, or only this client's moves, which it has
+            return
+        if self.holding or lag > MAX_BACKLOG:
+            # Too far behind what the client has applied: one snapshot replaces
+            # everything queued for it, and later ticks wait until it has that
+            self.lag['dropped'] += 1
+            metrics.inc('frames_dropped_total')
+            if not self.holding:
+                logger.info("Client %s is %d versions behind in room %s; sending a snapshot", self.player_id, lag, self.room_name)
+                self.holding = True
+                await self.send_board()
+            return
+        frame = event['frames'].get(self.protocol)
+        if frame is None:
+            # Moved before this client joined the room's protocols; its
+            # snapshot is newer than those moves anyway
+            await self.send_board()
+            return
+        await self.send_frame(frame)
+
+    async def leaderboard_update(self, event):
+        # Always JSON text, whatever the board protocol
+        payload = {"type": "leaderboard", "top": event["top"]}
+        if self.user.is_authenticated and leaderboard.loaded:
+            payload["rank"], _ = leaderboard.rank(self.user.id)
+        await self.send(text_data=json.dumps(payload))
@@ -0,0 +1,104 @@
+"""Database writes off the event loop, through one writer thread when enabled.
+
+With GAME_DB_WRITER on, functions decorated with ``writes`` are queued to a
+dedicated thread, which takes every job waiting when it wakes and commits
+them in one transaction, each inside its own savepoint so one failing job
+doesn't take the others down. SQLite lets one connection write at a time,
+so this turns write-lock contention and a commit per flush into one commit
+per batch, and keeps writes from queueing behind reads on the thread
+database_sync_to_async shares. With the writer off, ``writes`` is
+database_sync_to_async.
+"""
+import asyncio
+import functools
+import logging
+import queue
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Most jobs committed together; more wait for the next transaction
+WRITE_BATCH = 200
+
+
+def _resolve(future, exc, result):
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class DBWriter:
+    """A queue of write jobs drained by one daemon thread, started on first use."""
+
+    def __init__(self, max_batch=WRITE_BATCH):
+        self.max_batch = max_batch
+        self.jobs = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queues ``func(*args, **kwargs)``; returns a future for its result on the running loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.jobs.put((func, args, kwargs, loop, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='game-db-writer', daemon=True)
+                    self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            for (*_, loop, future), (exc, result) in zip(batch, self._commit(batch)):
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, exc, result)
+                except RuntimeError:
+                    # The loop that asked for this write has closed
+                    pass
+
+    def _commit(self, batch):
+        close_old_connections()
+        outcomes = []
+        try:
+            with transaction.atomic():
+                for func, args, kwargs, _, _ in batch:
+                    try:
+                        with transaction.atomic():
+                            outcomes.append((None, func(*args, **kwargs)))
+                    except Exception as exc:
+                        outcomes.append((exc, None))
+        except Exception as exc:
+            # The commit itself failed, so none of the batch landed
+            logger.exception("Failed to commit %d queued writes", len(batch))
+            outcomes = [(exc, None)] * len(batch)
+        return outcomes
+
+
+writer = DBWriter()
+
+
+def writes(func):
+    """Makes a synchronous write awaitable, running it on the writer thread when it is on."""
+    threaded = database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if settings.GAME_DB_WRITER:
+            return await writer.submit(func, *args, **kwargs)
+        return await threaded(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,492 @@
+import random
+from collections import namedtuple
+
+GEM_TYPES = ["red", "blue", "green", "yellow", "purple", "orange", "white"]
+
+# Cells hold small ints: 0 is an empty cell, 1..len(GEM_TYPES) are gems.
+EMPTY = 0
+GEM_CODES = {color: code for code, color in enumerate(GEM_TYPES, start=1)}
+
+# A board plays with the first ``kinds`` gems of GEM_TYPES. A cell being
+# filled can be hemmed in by three colors at once, a pair to its left, a pair
+# above and the planted move, so fewer than four kinds can leave it no gem
+# that avoids completing a run.
+MIN_GEM_KINDS = 4
+MAX_GEM_KINDS = len(GEM_TYPES)
+
+# One level of a cascade: the cleared indices, (from, to) index pairs for gems
+# that fell, and (index, gem) pairs for refills, in the order they happened.
+CascadeStep = namedtuple("CascadeStep", ["cleared", "falls", "spawns"])
+
+
+def touched_cells(swapped, steps):
+    """The cells a swap and its cascade wrote to; every other cell is as it was."""
+    touched = set(swapped)
+    for step in steps:
+        touched.update(to for _, to in step.falls)
+        touched.update(i for i, _ in step.spawns)
+    return touched
+
+
+class Board:
+    """A match-3 board stored as a flat bytearray, indexed ``y * width + x``.
+
+    Work after a move is bounded by the cells it changed rather than the
+    size of the board, so large boards cost little more per move than
+    small ones.
+    """
+
+    __slots__ = ("width", "height", "kinds", "cells", "_hint", "_moves")
+
+    def __init__(self, width=8, height=8, cells=None, kinds=MAX_GEM_KINDS):
+        self.width = width
+        self.height = height
+        self.kinds = kinds
+        self._hint = None
+        self._moves = None
+        if cells is None:
+            self.cells = bytearray(width * height)
+        else:
+            self.cells = bytearray(cells)
+
+    @classmethod
+    def generate(cls, width=8, height=8, rng=random, seed=None, kinds=MAX_GEM_KINDS):
+        """Builds a board with no runs and at least one legal move.
+
+        A move is planted first (two gems in a line plus a third one step off
+        the end), then every other cell gets a gem that does not complete a
+        run, so the work is one pass over the board with no retries.
+        """
+        if seed is not None:
+            rng = random.Random(seed)
+        board = cls(width, height, kinds=kinds)
+        cells = board.cells
+        gems = range(1, kinds + 1)
+
+        # Lay the template out horizontally and transpose it if vertical
+        vertical = height > width or (height >= 3 and rng.random() < 0.5)
+        span, depth = (height, width) if vertical else (width, height)
+        a = rng.randrange(span - 2)
+        row = rng.randrange(depth)
+        side = 1 if row == 0 else -1 if row == depth - 1 else rng.choice((1, -1))
+        if rng.random() < 0.5:
+            line, target = (a, a + 1), a + 2
+        else:
+            line, target = (a + 1, a + 2), a
+        planted = [(p, row) for p in line] + [(target, row + side)]
+        gem = rng.choice(gems)
+        for p, q in planted:
+            cells[p * width + q if vertical else q * width + p] = gem
+
+        for i in range(width * height):
+            if cells[i]:
+                continue
+            allowed = []
+            for gem in gems:
+                cells[i] = gem
+                if not board.makes_match(i):
+                    allowed.append(gem)
+            cells[i] = rng.choice(allowed)
+        return board
+
+    @classmethod
+    def from_colors(cls, rows):
+        """Builds a board from a nested list of color names (None or "" is empty)."""
+        height = len(rows)
+        width = len(rows[0]) if height else 0
+        cells = bytearray(width * height)
+        i = 0
+        for row in rows:
+            for color in row:
+                cells[i] = GEM_CODES.get(color, EMPTY) if color else EMPTY
+                i += 1
+        return cls(width, height, cells)
+
+    def to_colors(self):
+        """Returns the board as a nested list of color names, None for empties."""
+        names = [None] + GEM_TYPES
+        cells = self.cells
+        w = self.width
+        return [[names[c] for c in cells[y * w:(y + 1) * w]] for y in range(self.height)]
+
+    def copy(self):
+        return Board(self.width, self.height, self.cells, self.kinds)
+
+    def diff(self, before, indices=None):
+        """Returns ``[index, gem, index, gem, ...]`` for cells that differ from ``before``.
+
+        Only ``indices`` are compared when given, so a caller that knows which
+        cells a move touched doesn't pay for the rest of the board.
+        """
+        out = []
+        old = before.cells
+        cells = self.cells
+        for i in (range(len(cells)) if indices is None else sorted(indices)):
+            if cells[i] != old[i]:
+                out.append(i)
+                out.append(cells[i])
+        return out
+
+    def index(self, x, y):
+        return y * self.width + x
+
+    def get(self, x, y):
+        return self.cells[y * self.width + x]
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def swap(self, x1, y1, x2, y2):
+        cells = self.cells
+        a = y1 * self.width + x1
+        b = y2 * self.width + x2
+        cells[a], cells[b] = cells[b], cells[a]
+
+    def find_matches(self):
+        """Returns the set of flat indices that are part of a 3+ run."""
+        matched = set()
+        for y in range(self.height):
+            self._scan_row(y, matched)
+        for x in range(self.width):
+            self._scan_column(x, matched)
+        return matched
+
+    def find_matches_around(self, indices):
+        """Returns the runs passing through any of ``indices``.
+
+        If the board had no matches before those cells changed, every run
+        now on it passes through one of them, so this is the same set
+        ``find_matches`` would return. Each cell is only walked outwards
+        along its own run, and cells already walked are skipped.
+        """
+        cells = self.cells
+        w = self.width
+        size = len(cells)
+        matched = set()
+        across = set()
+        down = set()
+        for i in indices:
+            gem = cells[i]
+            if not gem:
+                continue
+            if i not in across:
+                lo = hi = i
+                while lo % w and cells[lo - 1] == gem:
+                    lo -= 1
+                while (hi + 1) % w and cells[hi + 1] == gem:
+                    hi += 1
+                run = range(lo, hi + 1)
+                across.update(run)
+                if hi - lo >= 2:
+                    matched.update(run)
+            if i not in down:
+                lo = hi = i
+                while lo >= w and cells[lo - w] == gem:
+                    lo -= w
+                while hi + w < size and cells[hi + w] == gem:
+                    hi += w
+                run = range(lo, hi + 1, w)
+                down.update(run)
+                if hi - lo >= 2 * w:
+                    matched.update(run)
+        return matched
+
+    def _scan_row(self, y, matched):
+        cells = self.cells
+        row = y * self.width
+        end = row + self.width
+        start = row
+        for i in range(row + 1, end + 1):
+            if i == end or cells[i] != cells[start]:
+                if i - start >= 3 and cells[start]:
+                    matched.update(range(start, i))
+                start = i
+
+    def _scan_column(self, x, matched):
+        cells = self.cells
+        w = self.width
+        size = len(cells)
+        start = x
+        for i in range(x + w, size + w, w):
+            if i >= size or cells[i] != cells[start]:
+                if i - start >= 3 * w and cells[start]:
+                    matched.update(range(start, i, w))
+                start = i
+
+    def makes_match(self, i):
+        """True if the gem at flat index ``i`` is part of a 3+ run."""
+        cells = self.cells
+        gem = cells[i]
+        if not gem:
+            return False
+        w = self.width
+        x = i % w
+
+        run = 1
+        j, k = i - 1, x - 1
+        while k >= 0 and cells[j] == gem:
+            run += 1
+            j -= 1
+            k -= 1
+        j, k = i + 1, x + 1
+        while k < w and cells[j] == gem:
+            run += 1
+            j += 1
+            k += 1
+        if run >= 3:
+            return True
+
+        run = 1
+        j = i - w
+        while j >= 0 and cells[j] == gem:
+            run += 1
+            j -= w
+        size = len(cells)
+        j = i + w
+        while j < size and cells[j] == gem:
+            run += 1
+            j += w
+        return run >= 3
+
+    def _lands_in_run(self, src, dst):
+        """True if the gem at ``src`` would complete a 3+ run when moved to ``dst``.
+
+        ``src`` is treated as holding a different gem, as it will after the swap.
+        """
+        cells = self.cells
+        gem = cells[src]
+        if not gem:
+            return False
+        w = self.width
+        x = dst % w
+
+        run = 1
+        j, k = dst - 1, x - 1
+        while k >= 0 and j != src and cells[j] == gem:
+            run += 1
+            j -= 1
+            k -= 1
+        j, k = dst + 1, x + 1
+        while k < w and j != src and cells[j] == gem:
+            run += 1
+            j += 1
+            k += 1
+        if run >= 3:
+            return True
+
+        run = 1
+        j = dst - w
+        while j >= 0 and j != src and cells[j] == gem:
+            run += 1
+            j -= w
+        size = len(cells)
+        j = dst + w
+        while j < size and j != src and cells[j] == gem:
+            run += 1
+            j += w
+        return run >= 3
+
+    def is_move(self, a, b):
+        """True if swapping flat indices ``a`` and ``b`` creates a match."""
+        cells = self.cells
+        if cells[a] == cells[b]:
+            return False
+        return self._lands_in_run(a, b) or self._lands_in_run(b, a)
+
+    def swap_makes_match(self, x1, y1, x2, y2):
+        """True if swapping the two cells lines up a run through either of them."""
+        w = self.width
+        return self.is_move(y1 * w + x1, y2 * w + x2)
+
+    def find_move(self):
+        """Returns the first matching swap as a pair of flat indices, or None.
+
+        Each cell is checked against the templates for moving its gem right or
+        down (and its neighbour's gem back), without touching the board.
+        """
+        w = self.width
+        size = len(self.cells)
+        for i in range(size):
+            if (i + 1) % w and self.is_move(i, i + 1):
+                return i, i + 1
+            if i + w < size and self.is_move(i, i + w):
+                return i, i + w
+        return None
+
+    def legal_moves(self):
+        """Returns the set of matching swaps as ``(a, b)`` flat index pairs, ``a < b``.
+
+        The set is built on first use and kept until the board changes, so
+        checking a move against it afterwards is a single lookup. Callers
+        must not modify it.
+        """
+        if self._moves is None:
+            w = self.width
+            size = len(self.cells)
+            moves = set()
+            for i in range(size):
+                if (i + 1) % w and self.is_move(i, i + 1):
+                    moves.add((i, i + 1))
+                if i + w < size and self.is_move(i, i + w):
+                    moves.add((i, i + w))
+            self._moves = moves
+        return self._moves
+
+    def hint(self):
+        """Returns a cached legal move, searching for one only when needed."""
+        if self._hint is None:
+            if self._moves is not None:
+                # The smallest pair is the one find_move would stop at
+                self._hint = min(self._moves) if self._moves else False
+            else:
+                self._hint = self.find_move() or False
+        return self._hint or None
+
+    def invalidate_hint(self, changed):
+        """Drops the cached hint if any index in ``changed`` can affect it.
+
+        A move only depends on cells up to two steps away from either swapped
+        cell along its row or column. The legal move set is brought up to
+        date by rechecking just the swaps near ``changed``, or dropped to be
+        rebuilt on next use when too much of the board changed for that to
+        be cheaper.
+        """
+        if changed and self._moves is not None:
+            if len(changed) * 8 > len(self.cells):
+                self._moves = None
+            else:
+                self._update_moves(changed)
+        hint = self._hint
+        if hint is None:
+            return
+        if hint is False:
+            # A board without moves can gain one anywhere
+            if changed:
+                self._hint = None
+            return
+        w = self.width
+        for c in changed:
+            cy, cx = divmod(c, w)
+            for i in hint:
+                y, x = divmod(i, w)
+                if (cy == y and abs(cx - x) <= 2) or (cx == x and abs(cy - y) <= 2):
+                    self._hint = None
+                    return
+
+    def _update_moves(self, changed):
+        moves = self._moves
+        w = self.width
+        size = len(self.cells)
+        near = set()
+        for c in changed:
+            x = c % w
+            for d in (-2, -1, 0, 1, 2):
+                if 0 <= x + d < w:
+                    near.add(c + d)
+                if 0 <= c + d * w < size:
+                    near.add(c + d * w)
+        pairs = set()
+        for i in near:
+            if (i + 1) % w:
+                pairs.add((i, i + 1))
+            if i % w:
+                pairs.add((i - 1, i))
+            if i + w < size:
+                pairs.add((i, i + w))
+            if i >= w:
+                pairs.add((i - w, i))
+        for a, b in pairs:
+            if self.is_move(a, b):
+                moves.add((a, b))
+            else:
+                moves.discard((a, b))
+        if self._hint and self._hint not in moves:
+            self._hint = None
+
+    def has_valid_moves(self):
+        """Checks if any adjacent swap results in a match."""
+        return self.hint() is not None
+
+    def clear(self, matches):
+        cells = self.cells
+        for i in matches:
+            cells[i] = EMPTY
+        return bool(matches)
+
+    def collapse(self, changed=None, falls=None, cleared=None):
+        """Compacts every column downwards in one pass, leaving empties on top.
+
+        Indices written are added to ``changed`` and ``(from, to)`` moves are
+        appended to ``falls`` when they are given. With ``cleared``, the only
+        empty cells on an otherwise full board, just their columns are
+        compacted, from the lowest of them up.
+        """
+        cells = self.cells
+        w = self.width
+        size = len(cells)
+        if cleared is None:
+            starts = range(size - w, size)
+        else:
+            lowest = {}
+            for i in cleared:
+                x = i % w
+                if i > lowest.get(x, -1):
+                    lowest[x] = i
+            starts = [lowest[x] for x in sorted(lowest)]
+        for write in starts:
+            for read in range(write, -1, -w):
+                gem = cells[read]
+                if gem:
+                    if read != write:
+                        cells[write] = gem
+                        cells[read] = EMPTY
+                        if changed is not None:
+                            changed.add(write)
+                        if falls is not None:
+                            falls.append((read, write))
+                    write -= w
+
+    def refill(self, rng=random, changed=None, spawns=None):
+        """Fills every empty cell with a random gem, in index order.
+
+        An ``rng`` with a ``gems`` method (see game/rng.py) draws them all at
+        once; others are asked for one ``randint`` per cell.
+        """
+        cells = self.cells
+        kinds = self.kinds
+        empty = []
+        i = cells.find(EMPTY)
+        while i != -1:
+            empty.append(i)
+            i = cells.find(EMPTY, i + 1)
+        if callable(getattr(rng, "gems", None)):
+            drawn = rng.gems(len(empty), kinds)
+        else:
+            drawn = [rng.randint(1, kinds) for _ in empty]
+        for i, gem in zip(empty, drawn):
+            cells[i] = gem
+        if changed is not None:
+            changed.update(empty)
+        if spawns is not None:
+            spawns.extend(zip(empty, drawn))
+
+    def cascade(self, matches, rng=random):
+        """Clears ``matches`` and resolves every follow-up match to a stable board.
+
+        Returns the list of CascadeSteps taken, one per level.
+        """
+        steps = []
+        touched = set()
+        while matches:
+            self.clear(matches)
+            changed = set(matches)
+            falls = []
+            spawns = []
+            self.collapse(changed, falls, matches)
+            self.refill(rng, changed, spawns)
+            steps.append(CascadeStep(sorted(matches), falls, spawns))
+            touched |= changed
+            # Only the lines gems fell through or were refilled into can hold new runs
+            matches = self.find_matches_around(changed)
+        self.invalidate_hint(touched)
+        return steps
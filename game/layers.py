@@ -0,0 +1,359 @@
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import time
+import uuid
+import weakref
+from collections import deque
+
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps for expired messages and the channels they abandon
+SWEEP_INTERVAL = 10.0
+
+
+# Messages travel as JSON lines; bytes values are wrapped so binary frames survive
+
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot send {type(value).__name__} over the broker")
+
+
+def _object_hook(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def encode(data):
+    return json.dumps(data, default=_default, separators=(',', ':')).encode() + b'\n'
+
+
+def decode(line):
+    return json.loads(line, object_hook=_object_hook)
+
+
+class Broker:
+    """A small message broker that worker processes share over a Unix socket.
+
+    It is a local stand-in for Redis when running several Daphne workers on
+    one machine: channels hold queued messages, blocked receives are answered
+    as soon as a message arrives, and groups fan messages out to channels.
+    Memberships and pending receives die with the connection that made them.
+
+    Queued messages carry the time they expire, by default ``expiry`` seconds
+    after they arrive, and are never handed out after it. As with the
+    in-memory layer, a channel with an expired message is taken to have lost
+    its reader: a periodic sweep drops its queue and its group memberships.
+    """
+
+    def __init__(self, capacity=100, expiry=60):
+        self.capacity = capacity
+        self.expiry = expiry
+        # channel -> deque of (expires, message)
+        self.queues = {}
+        self.waiters = {}
+        self.groups = {}
+
+    async def serve(self, path):
+        server = await asyncio.start_unix_server(self._client, path=path)
+        sweeper = asyncio.ensure_future(self._sweep_forever())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+    async def _client(self, reader, writer):
+        conn = _BrokerConnection(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._handle(conn, decode(line))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            conn.closed = True
+            for group, channel in conn.memberships:
+                self._discard(group, channel)
+            for channel in conn.waiting:
+                waiters = self.waiters.get(channel)
+                if waiters is not None:
+                    waiters = deque(waiter for waiter in waiters if waiter[0] is not conn)
+                    if waiters:
+                        self.waiters[channel] = waiters
+                    else:
+                        del self.waiters[channel]
+            writer.close()
+
+    def _handle(self, conn, request):
+        op = request['op']
+        if op == 'send':
+            self._deliver(request['channel'], request['message'], self._expires(request))
+        elif op == 'receive':
+            channel = request['channel']
+            message = self._pop(channel)
+            if message is not None:
+                conn.reply(request['id'], channel, message)
+            else:
+                self.waiters.setdefault(channel, deque()).append((conn, request['id']))
+                conn.waiting.add(channel)
+        elif op == 'cancel':
+            channel = request['channel']
+            waiters = self.waiters.get(channel)
+            if waiters:
+                try:
+                    waiters.remove((conn, request['id']))
+                except ValueError:
+                    pass
+                if not waiters:
+                    del self.waiters[channel]
+        elif op == 'group_add':
+            self.groups.setdefault(request['group'], set()).add(request['channel'])
+            conn.memberships.add((request['group'], request['channel']))
+        elif op == 'group_discard':
+            self._discard(request['group'], request['channel'])
+            conn.memberships.discard((request['group'], request['channel']))
+        elif op == 'group_send':
+            expires = self._expires(request)
+            for channel in list(self.groups.get(request['group'], ())):
+                self._deliver(channel, request['message'], expires)
+        elif op == 'flush':
+            self.queues.clear()
+            self.groups.clear()
+
+    def _expires(self, request):
+        return time.monotonic() + request.get('expiry', self.expiry)
+
+    def _discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+
+    def _pop(self, channel):
+        # The oldest message that has not expired, dropping expired ones on the way
+        queue = self.queues.get(channel)
+        now = time.monotonic()
+        message = None
+        while queue:
+            expires, queued = queue.popleft()
+            if expires > now:
+                message = queued
+                break
+        if queue is not None and not queue:
+            del self.queues[channel]
+        return message
+
+    def _deliver(self, channel, message, expires):
+        waiters = self.waiters.get(channel)
+        while waiters:
+            conn, request_id = waiters.popleft()
+            if not waiters:
+                del self.waiters[channel]
+            if not conn.closed:
+                conn.reply(request_id, channel, message)
+                return
+        queue = self.queues.setdefault(channel, deque())
+        now = time.monotonic()
+        while queue and queue[0][0] <= now:
+            queue.popleft()
+        if len(queue) >= self.capacity:
+            # Like a full channel elsewhere, the newest message is dropped
+            logger.warning("Channel %s is full; dropping message", channel)
+            return
+        queue.append((expires, message))
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def sweep(self):
+        """Drops the queues and memberships of channels whose messages went unread."""
+        now = time.monotonic()
+        abandoned = {channel for channel, queue in self.queues.items()
+                     if any(expires <= now for expires, _ in queue)}
+        for channel in abandoned:
+            del self.queues[channel]
+        if abandoned:
+            for group, members in list(self.groups.items()):
+                members -= abandoned
+                if not members:
+                    del self.groups[group]
+
+
+class _BrokerConnection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.closed = False
+        self.memberships = set()
+        # Channels this connection has had receives waiting on
+        self.waiting = set()
+
+    def reply(self, request_id, channel, message):
+        self.writer.write(encode({'id': request_id, 'channel': channel, 'message': message}))
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """Channel layer backed by a Broker listening on a Unix socket.
+
+    Configure it with CONFIG {"path": "/path/to/socket"} and run the broker
+    with ``manage.py run_broker``.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, path, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.client_prefix = uuid.uuid4().hex
+        # One connection per event loop, since streams are bound to their loop
+        self._connections = weakref.WeakKeyDictionary()
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        conn = self._connections.get(loop)
+        if conn is None:
+            conn = self._connections[loop] = _LayerConnection(self.path, self.expiry)
+        await conn.open()
+        return conn
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        conn = await self._connection()
+        await conn.request(op='send', channel=channel, message=message, expiry=self.expiry)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        conn = await self._connection()
+        return await conn.receive(channel)
+
+    async def new_channel(self, prefix="specific."):
+        return f"{prefix}{self.client_prefix}!{uuid.uuid4().hex}"
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        conn = await self._connection()
+        await conn.request(op='group_add', group=group, channel=channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        conn = await self._connection()
+        await conn.request(op='group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        conn = await self._connection()
+        await conn.request(op='group_send', group=group, message=message, expiry=self.expiry)
+
+    async def flush(self):
+        conn = await self._connection()
+        await conn.request(op='flush')
+
+    async def close(self):
+        conn = self._connections.pop(asyncio.get_running_loop(), None)
+        if conn is not None:
+            await conn.close()
+
+
+class _LayerConnection:
+    def __init__(self, path, expiry):
+        self.path = path
+        self.expiry = expiry
+        self.reader = None
+        self.writer = None
+        self.ids = itertools.count()
+        self.pending = {}
+        # Messages that arrived for a receive that was cancelled meanwhile,
+        # channel -> deque of (expires, message)
+        self.buffered = {}
+        self._opening = None
+        self._reader_task = None
+
+    async def open(self):
+        if self.writer is not None:
+            return
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._opening)
+        finally:
+            self._opening = None
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = asyncio.ensure_future(self._read())
+
+    async def request(self, **request):
+        self.writer.write(encode(request))
+        await self.writer.drain()
+
+    async def receive(self, channel):
+        buffered = self.buffered.get(channel)
+        if buffered is not None:
+            now = time.monotonic()
+            message = None
+            while buffered and message is None:
+                expires, queued = buffered.popleft()
+                if expires > now:
+                    message = queued
+            if not buffered:
+                del self.buffered[channel]
+            if message is not None:
+                return message
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        await self.request(op='receive', id=request_id, channel=channel)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self.pending.pop(request_id, None) is not None and self.writer is not None:
+                self.writer.write(encode({'op': 'cancel', 'id': request_id, 'channel': channel}))
+            raise
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                reply = decode(line)
+                future = self.pending.pop(reply['id'], None)
+                if future is None or future.done():
+                    self._buffer(reply['channel'], reply['message'])
+                else:
+                    future.set_result(reply['message'])
+        finally:
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to the broker"))
+            self.pending.clear()
+
+    def _buffer(self, channel, message):
+        # Channels whose reader went away would keep their message for good,
+        # so whatever has expired goes whenever another is kept
+        now = time.monotonic()
+        for stale in [name for name, queue in self.buffered.items() if queue[-1][0] <= now]:
+            del self.buffered[stale]
+        self.buffered.setdefault(channel, deque()).append((now + self.expiry, message))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
@@ -0,0 +1,165 @@
+import asyncio
+import bisect
+import logging
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.utils import timezone
+
+from .affinity import worker_id
+from .models import GamePlayer
+
+logger = logging.getLogger(__name__)
+
+# How many entries sockets are sent when the top of the board changes
+PUSH_SIZE = 10
+# Most pushes per second; changes in between go out together
+PUSH_INTERVAL = 2.0
+# Seconds between catch-up reads of scores committed by other processes
+SYNC_INTERVAL = 5.0
+
+
+def leaderboard_group():
+    """The group of this worker's sockets, the only ones its pushes go to."""
+    return f'leaderboard.{worker_id()}'
+
+
+class Leaderboard:
+    """Every player's score in memory, kept sorted for top-N and rank lookups.
+
+    ``order`` holds (-score, user_id) in ascending order, so the best player
+    comes first and a rank is one bisect. It is read from GamePlayer once,
+    then moved along by this process's score commits as they land and by a
+    read of rows other processes changed every SYNC_INTERVAL seconds.
+    Ranks are competition style: tied players share the best rank. Every
+    worker pushes changes to the top from its own board to its own sockets,
+    so a client hears of each change once.
+    """
+
+    def __init__(self, sync_interval=SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self.scores = {}
+        self.names = {}
+        self.order = []
+        self.loaded = False
+        self._since = None
+        self._loading = None
+        self._syncing = None
+        self._pusher = None
+        self._pushed = None
+
+    def set(self, user_id, score, name=None):
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        order = self.order
+        if old is not None:
+            del order[bisect.bisect_left(order, (-old, user_id))]
+        self.scores[user_id] = score
+        bisect.insort(order, (-score, user_id))
+        if name is not None:
+            self.names[user_id] = name
+
+    def rank(self, user_id):
+        """Returns (rank, score); players without points yet rank as scoring 0."""
+        score = self.scores.get(user_id, 0)
+        return bisect.bisect_left(self.order, (-score,)) + 1, score
+
+    def top(self, n):
+        entries = []
+        for k, (negative, user_id) in enumerate(self.order[:n]):
+            rank = entries[-1]['rank'] if entries and entries[-1]['score'] == -negative else k + 1
+            entries.append({'rank': rank, 'username': self.names.get(user_id), 'score': -negative})
+        return entries
+
+    async def ready(self):
+        """Loads the board on first use and starts the catch-up reads that keep it current."""
+        if not self.loaded:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load())
+            try:
+                await asyncio.shield(self._loading)
+            except Exception:
+                self._loading = None
+                raise
+        if self._syncing is None or self._syncing.done():
+            self._syncing = asyncio.ensure_future(self._keep_synced())
+
+    async def record(self, batch):
+        """Applies committed points, {user_id: points}, and schedules a push if the top changed."""
+        if not self.loaded:
+            # The load reads these points from the database
+            return
+        before = self.order[:PUSH_SIZE]
+        for user_id, points in batch.items():
+            self.set(user_id, self.scores.get(user_id, 0) + points)
+        missing = [user_id for user_id in batch if user_id not in self.names]
+        if missing:
+            self.names.update(await self._read_names(missing))
+        if self.order[:PUSH_SIZE] != before:
+            self.changed()
+
+    def changed(self):
+        if self._pusher is None or self._pusher.done():
+            self._pusher = asyncio.ensure_future(self._push())
+
+    async def _push(self):
+        # Sends at once, then at most once per PUSH_INTERVAL while the top keeps changing
+        while True:
+            top = self.top(PUSH_SIZE)
+            if top == self._pushed:
+                return
+            self._pushed = top
+            try:
+                await get_channel_layer().group_send(leaderboard_group(), {'type': 'leaderboard_update', 'top': top})
+            except Exception:
+                logger.exception("Failed to push the leaderboard")
+            await asyncio.sleep(PUSH_INTERVAL)
+
+    async def _load(self):
+        started = timezone.now()
+        rows = await self._read()
+        for user_id, name, score in rows:
+            self.scores[user_id] = score
+            self.names[user_id] = name
+        self.order = sorted((-score, user_id) for user_id, score in self.scores.items())
+        self._since = started
+        self.loaded = True
+
+    async def _keep_synced(self):
+        # Runs for the life of the process, so other workers' commits show up
+        # whether or not anything here asks for the board
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self._sync()
+
+    async def _sync(self):
+        # Overlapping windows re-read a few rows rather than miss a commit
+        # that landed while the last read ran
+        started = timezone.now()
+        try:
+            rows = await self._read(self._since - timedelta(seconds=self.sync_interval))
+        except Exception:
+            logger.exception("Failed to sync the leaderboard")
+            return
+        before = self.order[:PUSH_SIZE]
+        for user_id, name, score in rows:
+            self.set(user_id, score, name)
+        self._since = started
+        if self.order[:PUSH_SIZE] != before:
+            self.changed()
+
+    @database_sync_to_async
+    def _read(self, since=None):
+        players = GamePlayer.objects.all()
+        if since is not None:
+            players = players.filter(updated__gte=since)
+        return list(players.values_list('user_id', 'user__username', 'score'))
+
+    @database_sync_to_async
+    def _read_names(self, user_ids):
+        return dict(GamePlayer.objects.filter(user_id__in=user_ids).values_list('user_id', 'user__username'))
+
+
+leaderboard = Leaderboard()
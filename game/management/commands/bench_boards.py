@@ -0,0 +1,72 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.engine import MAX_GEM_KINDS, MIN_GEM_KINDS, Board
+from game.metrics import percentile
+from game.protocol import encode, move_payload
+from game.rng import GemRNG
+from game.rooms import BOARD_PRESETS, Room
+
+
+def _shape(text):
+    # "WxH" or "WxH/kinds"
+    size, _, kinds = text.partition("/")
+    width, _, height = size.partition("x")
+    return int(width), int(height or width), int(kinds or MAX_GEM_KINDS)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures per-move latency on a room as the board grows: the legality check, "
+        "the swap and its cascade, then encoding the move for the delta and binary "
+        "protocols and, separately, for json, which sends the whole board every move."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("shapes", nargs="*",
+                            help="Board shapes as WxH or WxH/kinds (default: every room preset)")
+        parser.add_argument("--moves", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            shapes = [_shape(text) for text in options["shapes"]] or list(BOARD_PRESETS.values())
+        except ValueError:
+            raise CommandError("Shapes look like 16x16 or 16x16/5")
+        for width, height, kinds in shapes:
+            if not (3 <= width <= 255 and 3 <= height <= 255 and MIN_GEM_KINDS <= kinds <= MAX_GEM_KINDS):
+                raise CommandError(f"{width}x{height}/{kinds} is not a playable board")
+
+        columns = ("move", "delta+binary", "json")
+        self.stdout.write(f"{'board':>10} {'cells':>6}" + "".join(f" {c + ' p50':>17} {'p99':>8}" for c in columns))
+        for width, height, kinds in shapes:
+            timings = self.play(width, height, kinds, options["moves"], options["seed"])
+            self.stdout.write(f"{f'{width}x{height}/{kinds}':>10} {width * height:>6}" + "".join(
+                f" {percentile(samples, 0.5) * 1e6:>15.0f}us {percentile(samples, 0.99) * 1e6:>6.0f}us"
+                for samples in timings
+            ))
+
+    def play(self, width, height, kinds, count, seed):
+        # Plays the hint, as a client following it would; the hint is always legal
+        rng = GemRNG(seed)
+        room = Room("bench", uuid.uuid4(), Board.generate(width, height, rng, kinds=kinds), 0, rng)
+        moves = []
+        compact = []
+        full = []
+        for _ in range(count):
+            a, b = room.board.hint()
+            started = time.perf_counter()
+            if room.check_move(a % width, a // width, b % width, b // width, room.version) is not None:
+                raise CommandError("The hint was not a legal move")
+            move = room.apply_swap(a % width, a // width, b % width, b // width)
+            moved = time.perf_counter()
+            for protocol in ("delta", "binary"):
+                encode(protocol, move_payload(protocol, room, move, "bench"))
+            encoded = time.perf_counter()
+            encode("json", move_payload("json", room, move, "bench"))
+            moves.append(moved - started)
+            compact.append(encoded - moved)
+            full.append(time.perf_counter() - encoded)
+        return moves, compact, full
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from game.metrics import percentile
+from game.models import GameBoard, GamePlayer
+from game.rooms import RoomStore, board_id_for
+from game.scores import ScoreBuffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures database write throughput under concurrent moves: rooms play and "
+        "flush their board and move log after every move while players commit points, "
+        "all through the game's own write paths. The players, boards and logs it "
+        "creates are deleted when it finishes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--players", type=int, default=50, help="Players committing points alongside the rooms")
+        parser.add_argument("--moves", type=int, default=40, help="Moves, and so flushes, per room")
+        parser.add_argument(
+            "--writer", action=argparse.BooleanOptionalAction, default=settings.GAME_DB_WRITER,
+            help="Route writes through the writer thread (default: GAME_DB_WRITER)",
+        )
+
+    def handle(self, *args, **options):
+        settings.GAME_DB_WRITER = options["writer"]
+        users = []
+        for i in range(options["players"]):
+            user, _ = User.objects.get_or_create(username=f"bench-db-{i}")
+            GamePlayer.objects.get_or_create(user=user)
+            users.append(user.id)
+        names = [f"bench-db-{i}" for i in range(options["rooms"])]
+        mode = connection.vendor
+        if mode == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                mode += f" ({cursor.fetchone()[0]})"
+
+        try:
+            room_times, score_times, elapsed = asyncio.run(self.run(names, users, options["moves"]))
+        finally:
+            # Everything the bench made goes, or its players would sit on the
+            # leaderboard and its boards and logs pile up run after run.
+            # GamePlayers and MoveLogs go with their users and boards.
+            User.objects.filter(username__in=[f"bench-db-{i}" for i in range(options["players"])]).delete()
+            GameBoard.objects.filter(id__in=[board_id_for(name) for name in names]).delete()
+
+        writes = len(room_times) + len(score_times)
+        self.stdout.write(
+            f"{mode}, writer {'on' if options['writer'] else 'off'}: {writes} writes in {elapsed:.2f}s, "
+            f"{writes / elapsed:.0f} writes/sec"
+        )
+        for label, samples in (("room flush", room_times), ("score commit", score_times)):
+            if samples:
+                self.stdout.write(
+                    f"  {label:<12} p50 {percentile(samples, 0.5) * 1000:7.2f}ms  "
+                    f"p99 {percentile(samples, 0.99) * 1000:7.2f}ms"
+                )
+
+    async def run(self, names, users, moves):
+        store = RoomStore()
+        rooms = [await store.join(name) for name in names]
+        room_times = []
+        score_times = []
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(self.play(store, room, moves, room_times) for room in rooms),
+            *(self.score(user_id, moves, score_times) for user_id in users),
+        )
+        elapsed = time.perf_counter() - start
+        for room in rooms:
+            room.clients -= 1
+        return room_times, score_times, elapsed
+
+    async def play(self, store, room, moves, times):
+        width = room.board.width
+        for _ in range(moves):
+            a, b = min(room.board.legal_moves())
+            room.apply_swap(a % width, a // width, b % width, b // width)
+            started = time.perf_counter()
+            await store.flush(room)
+            times.append(time.perf_counter() - started)
+
+    async def score(self, user_id, moves, times):
+        buffer = ScoreBuffer()
+        for _ in range(moves):
+            buffer.add(user_id, 10)
+            started = time.perf_counter()
+            await buffer.flush()
+            times.append(time.perf_counter() - started)
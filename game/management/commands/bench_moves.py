@@ -0,0 +1,94 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+
+from game import consumers
+from game.models import GameBoard
+from game.rooms import board_id_for
+from game.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures room move throughput with concurrent in-process clients. The "
+        "bench rooms' boards and move logs are deleted when it finishes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=20)
+        parser.add_argument("--rooms", type=int, default=1, help="Clients are spread evenly over this many rooms")
+        parser.add_argument("--moves", type=int, default=50, help="Moves per client")
+
+    def handle(self, *args, **options):
+        # Clients move as fast as replies come back, which the per-connection
+        # rate limit exists to stop; the bench measures the room instead
+        consumers.MESSAGE_RATE = consumers.MESSAGE_BURST = float("inf")
+        try:
+            accepted, rejections, elapsed = asyncio.run(self.run(options))
+        finally:
+            # The rooms' boards would otherwise pile up run after run; their
+            # move logs go with them
+            GameBoard.objects.filter(
+                id__in=[board_id_for(f"bench-{i}") for i in range(options["rooms"])]
+            ).delete()
+        total = accepted + sum(rejections.values())
+        self.stdout.write(
+            f"{options['clients']} clients in {options['rooms']} rooms, {total} moves in {elapsed:.2f}s: "
+            f"{accepted / elapsed:.0f} applied moves/sec ({accepted} applied), "
+            f"{total / elapsed:.0f} moves/sec answered"
+        )
+        if rejections:
+            self.stdout.write("rejected: " + ", ".join(
+                f"{reason} {count}" for reason, count in rejections.most_common()
+            ))
+
+    async def run(self, options):
+        app = URLRouter(websocket_urlpatterns)
+        clients = []
+        for i in range(options["clients"]):
+            client = WebsocketCommunicator(app, f"/ws/game/bench-{i % options['rooms']}/")
+            client.scope["user"] = AnonymousUser()
+            connected, _ = await client.connect()
+            if not connected:
+                raise RuntimeError("Client failed to connect")
+            hello = json.loads(await client.receive_from())
+            clients.append((client, hello))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self.play(client, hello, options["moves"]) for client, hello in clients))
+        elapsed = time.perf_counter() - start
+
+        for client, _ in clients:
+            await client.disconnect()
+        return sum(r[0] for r in results), sum((r[1] for r in results), Counter()), elapsed
+
+    async def play(self, client, hello, moves):
+        # Plays the last hint it saw at the version it saw it; other clients
+        # may have moved since, in which case the server rejects it as stale
+        hint, version = hello["hint"], hello["version"]
+        accepted = 0
+        rejections = Counter()
+        for seq in range(moves):
+            x1, y1, x2, y2 = hint
+            await client.send_to(text_data=json.dumps(
+                {"x1": x1, "y1": y1, "x2": x2, "y2": y2, "seq": seq, "v": version}
+            ))
+            while True:
+                frame = json.loads(await client.receive_from(timeout=10))
+                if frame.get("hint"):
+                    hint = frame["hint"]
+                if "version" in frame:
+                    version = frame["version"]
+                if frame.get("seq") == seq:
+                    break
+            if frame.get("rejected"):
+                rejections[frame.get("reason") or "unknown"] += 1
+            else:
+                accepted += 1
+        return accepted, rejections
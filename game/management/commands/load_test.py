@@ -0,0 +1,297 @@
+import asyncio
+import json
+import random
+import resource
+import time
+from collections import Counter
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from game.metrics import percentile
+from game.protocol import PROTOCOLS, decode_binary, encode_client_ack, encode_client_move
+from game.wsclient import ConnectionClosed, HandshakeError, WebSocketClient
+
+# Seconds a client waits for the reply to its move
+REPLY_TIMEOUT = 10.0
+
+
+def frame_version(message):
+    return message.get('v', message.get('version'))
+
+
+def server_rss(pid):
+    """Resident memory of a local process in bytes, from /proc."""
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class LoadStats:
+    def __init__(self):
+        self.connected = self.failed = 0
+        self.sent = self.received = 0
+        self.applied = self.rejected = self.timeouts = 0
+        self.rejections = Counter()
+        self.reply_latency = []
+        # When each applied move was sent, by (room, version)
+        self.moved_at = {}
+        # (room, version, time) for every frame a client got about someone else's move
+        self.deliveries = []
+
+    def broadcast_latency(self):
+        return sorted(
+            at - self.moved_at[room, version]
+            for room, version, at in self.deliveries
+            if (room, version) in self.moved_at
+        )
+
+
+class LoadClient:
+    """One simulated player: plays the latest hint it has seen after a think time."""
+
+    def __init__(self, url, room, mode, cookie, stats, rng):
+        self.url = f"{url.rstrip('/')}/ws/game/{room}/?mode={mode}"
+        self.room = room
+        self.mode = mode
+        self.headers = {'Cookie': cookie} if cookie else {}
+        self.stats = stats
+        self.rng = rng
+        self.ws = None
+        self.hint = None
+        self.version = None
+        self.seq = 0
+        self.waiting = None
+
+    def decode(self, frame):
+        return decode_binary(frame) if isinstance(frame, bytes) else json.loads(frame)
+
+    async def run(self, delay, end, think, moving):
+        await asyncio.sleep(delay)
+        try:
+            self.ws = await WebSocketClient.connect(self.url, self.headers)
+            hello = self.decode(await self.ws.recv())
+        except (OSError, ConnectionClosed, HandshakeError):
+            self.stats.failed += 1
+            return
+        self.stats.connected += 1
+        self.stats.received += 1
+        self.hint = hello.get('hint')
+        self.version = frame_version(hello)
+        reader = asyncio.ensure_future(self.read())
+        try:
+            if moving:
+                await self.play(end, think)
+            else:
+                await asyncio.sleep(max(0.0, end - time.perf_counter()))
+        except ConnectionClosed:
+            pass
+        finally:
+            reader.cancel()
+            await self.ws.close()
+
+    async def read(self):
+        stats = self.stats
+        try:
+            while True:
+                message = self.decode(await self.ws.recv())
+                now = time.perf_counter()
+                stats.received += 1
+                if message.get('type') == 'leaderboard':
+                    continue
+                if message.get('hint'):
+                    self.hint = message['hint']
+                version = frame_version(message)
+                if version is not None and version != self.version:
+                    self.version = version
+                    # Like the browser client, acknowledge what was applied,
+                    # or the server holds broadcasts back
+                    await self.ws.send(
+                        encode_client_ack(version) if self.mode == 'binary' else json.dumps({'type': 'ack', 'v': version})
+                    )
+                waiting = self.waiting
+                if waiting is not None and message.get('seq') == self.seq:
+                    if not waiting.done():
+                        waiting.set_result((message, now))
+                elif version is not None:
+                    # A frame merging several moves delivers each of them
+                    first = message['base'] + 1 if 'base' in message and 'swap' not in message else version
+                    stats.deliveries.extend((self.room, v, now) for v in range(first, version + 1))
+        except ConnectionClosed:
+            waiting = self.waiting
+            if waiting is not None and not waiting.done():
+                waiting.set_exception(ConnectionClosed())
+
+    async def play(self, end, think):
+        stats = self.stats
+        loop = asyncio.get_running_loop()
+        while time.perf_counter() < end:
+            await asyncio.sleep(think * self.rng.uniform(0.5, 1.5))
+            if not self.hint or time.perf_counter() >= end:
+                continue
+            x1, y1, x2, y2 = self.hint
+            self.seq += 1
+            self.waiting = loop.create_future()
+            if self.mode == 'binary':
+                frame = encode_client_move(x1, y1, x2, y2, self.seq, self.version)
+            else:
+                frame = json.dumps({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'seq': self.seq, 'v': self.version})
+            sent = time.perf_counter()
+            await self.ws.send(frame)
+            stats.sent += 1
+            try:
+                reply, received = await asyncio.wait_for(self.waiting, REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                continue
+            finally:
+                self.waiting = None
+            stats.reply_latency.append(received - sent)
+            if reply.get('rejected'):
+                stats.rejected += 1
+                stats.rejections[reply.get('reason') or 'unknown'] += 1
+            else:
+                stats.applied += 1
+                stats.moved_at[self.room, frame_version(reply)] = sent
+
+
+class Command(BaseCommand):
+    help = (
+        "Opens simulated players against a running server and reports move latency, "
+        "move-to-broadcast latency, message rates and server memory. Signed-in "
+        "clients' sessions are deleted when the run ends; their loadtest-N users "
+        "and scores are kept unless --delete-users is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="ws://127.0.0.1:8000")
+        parser.add_argument("--clients", type=int, default=100)
+        parser.add_argument("--rooms", type=int, default=10, help="Clients are spread evenly over this many rooms")
+        parser.add_argument("--spectators", type=int, default=0, help="How many of the clients only watch")
+        parser.add_argument("--users", type=int, default=0,
+                            help="How many of the clients sign in, as loadtest-N users created on demand")
+        parser.add_argument("--delete-users", action="store_true",
+                            help="Delete the loadtest-N users, and with them their scores, when the run ends")
+        parser.add_argument("--mode", choices=PROTOCOLS, default="delta")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to play once everyone is connected")
+        parser.add_argument("--think", type=float, default=1.0, help="Mean seconds between a player's moves")
+        parser.add_argument("--connect-rate", type=float, default=200.0, help="New connections per second")
+        parser.add_argument("--pid", type=int, help="Server process to sample memory from")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        clients = options["clients"]
+        if options["users"] > clients:
+            raise CommandError("--users can't exceed --clients")
+        self.raise_file_limit(clients)
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        sessions = self.sign_in(store, options["users"])
+        cookies = [f"{settings.SESSION_COOKIE_NAME}={key}" for key in sessions]
+        try:
+            stats, elapsed, memory = asyncio.run(self.run(options, cookies))
+        finally:
+            for key in sessions:
+                store(key).delete()
+            if options["delete_users"]:
+                User.objects.filter(username__in=[f"loadtest-{i}" for i in range(options["users"])]).delete()
+        self.report(options, stats, elapsed, memory)
+
+    def raise_file_limit(self, clients):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = clients + 64
+        if soft < wanted:
+            target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            if target < wanted:
+                self.stderr.write(f"Only {target} file descriptors are available; some clients will fail")
+
+    def sign_in(self, store, count):
+        """Creates a session for each load test user and returns their session keys."""
+        keys = []
+        for i in range(count):
+            user, created = User.objects.get_or_create(username=f"loadtest-{i}")
+            if created:
+                user.set_unusable_password()
+                user.save()
+            session = store()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            keys.append(session.session_key)
+        return keys
+
+    async def run(self, options, cookies):
+        stats = LoadStats()
+        clients = options["clients"]
+        ramp = clients / options["connect_rate"]
+        start = time.perf_counter()
+        end = start + ramp + options["duration"]
+        rng = random.Random(options["seed"])
+
+        memory = []
+        sampler = None
+        if options["pid"]:
+            sampler = asyncio.ensure_future(self.sample_memory(options["pid"], memory))
+
+        players = []
+        for i in range(clients):
+            client = LoadClient(
+                options["url"], f"load-{i % options['rooms']}", options["mode"],
+                cookies[i] if i < len(cookies) else None, stats, random.Random(rng.random()),
+            )
+            moving = i < clients - options["spectators"]
+            players.append(client.run(i / options["connect_rate"], end, options["think"], moving))
+        await asyncio.gather(*players)
+        elapsed = time.perf_counter() - start
+
+        if sampler is not None:
+            sampler.cancel()
+            memory.append(server_rss(options["pid"]))
+        return stats, elapsed, memory
+
+    async def sample_memory(self, pid, memory):
+        while True:
+            memory.append(server_rss(pid))
+            await asyncio.sleep(1.0)
+
+    def report(self, options, stats, elapsed, memory):
+        self.stdout.write(
+            f"{options['clients']} clients ({options['users']} signed in, {options['spectators']} watching) "
+            f"in {options['rooms']} rooms over {elapsed:.1f}s, {options['mode']} mode"
+        )
+        self.stdout.write(f"connected {stats.connected}, failed {stats.failed}")
+        self.stdout.write(
+            f"moves: {stats.sent} sent, {stats.applied} applied, {stats.rejected} rejected, "
+            f"{stats.timeouts} timed out"
+        )
+        if stats.rejections:
+            self.stdout.write("rejected: " + ", ".join(
+                f"{reason} {count}" for reason, count in stats.rejections.most_common()
+            ))
+        self.write_latency("move reply", sorted(stats.reply_latency))
+        self.write_latency("move to broadcast", stats.broadcast_latency())
+        self.stdout.write(
+            f"messages: {stats.received / elapsed:.0f}/sec received, {stats.sent / elapsed:.0f}/sec sent"
+        )
+        if memory:
+            mb = 1024 * 1024
+            self.stdout.write(
+                f"server memory: start {memory[0] / mb:.1f} MB, peak {max(memory) / mb:.1f} MB, "
+                f"end {memory[-1] / mb:.1f} MB"
+            )
+
+    def write_latency(self, label, values):
+        if not values:
+            self.stdout.write(f"{label} latency: no samples")
+            return
+        ms = [v * 1000 for v in values]
+        self.stdout.write(
+            f"{label} latency (ms, {len(ms)} samples): p50 {percentile(ms, 0.5):.1f}, "
+            f"p90 {percentile(ms, 0.9):.1f}, p99 {percentile(ms, 0.99):.1f}, max {ms[-1]:.1f}"
+        )
@@ -0,0 +1,65 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game.models import GameBoard, MoveLog
+from game.movelog import LogError, replay
+from game.rooms import DEFAULT_ROOM, board_id_for
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a room's move log, checking every move against the rules and the "
+        "final board against the stored one, and reports the log's size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room", nargs="?", default=DEFAULT_ROOM)
+        parser.add_argument("--board", type=uuid.UUID, help="Replay this GameBoard id instead of a room's")
+        parser.add_argument("--at", type=int, help="Print the board as of this version")
+
+    def handle(self, *args, **options):
+        board_id = options["board"] or board_id_for(options["room"])
+        try:
+            game_board = GameBoard.objects.get(id=board_id)
+        except GameBoard.DoesNotExist:
+            raise CommandError(f"No board {board_id}")
+        segments = list(MoveLog.objects.filter(board_id=board_id).order_by("start_version", "id"))
+        if not segments:
+            raise CommandError(f"Board {board_id} has no move log")
+        for previous, segment in zip(segments, segments[1:]):
+            if segment.start_version != previous.end_version:
+                raise CommandError(
+                    f"The log skips from version {previous.end_version} to {segment.start_version}"
+                )
+
+        at = options["at"]
+        shown = None
+        moves = 0
+        version = board = None
+        try:
+            for version, board in replay((bytes(s.data) for s in segments), segments[0].start_version):
+                if version == at:
+                    shown = board.copy()
+                moves = version - segments[0].start_version
+        except LogError as exc:
+            raise CommandError(f"The log does not replay: {exc}")
+
+        size = sum(len(s.data) for s in segments)
+        self.stdout.write(
+            f"board {board_id}: versions {segments[0].start_version}-{version}, {moves} moves "
+            f"in {len(segments)} segments, {size} bytes ({size / max(moves, 1):.1f} per move)"
+        )
+        if at is not None:
+            if shown is None:
+                raise CommandError(f"Version {at} is not in the log")
+            w = shown.width
+            for y in range(shown.height):
+                self.stdout.write(" ".join(str(gem) for gem in shown.cells[y * w:(y + 1) * w]))
+
+        if version != game_board.version:
+            self.stdout.write(f"the stored board is at version {game_board.version}; not compared")
+        elif game_board.board is None or board.cells != game_board.board.cells:
+            raise CommandError("The replayed board differs from the stored one")
+        else:
+            self.stdout.write("the replayed board matches the stored one")
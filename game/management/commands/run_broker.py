@@ -0,0 +1,29 @@
+import asyncio
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from game.layers import Broker
+
+
+class Command(BaseCommand):
+    help = "Runs the local channel layer broker that several workers can share."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default=getattr(settings, "GAME_BROKER_SOCKET", "") or "/tmp/rejeweled.sock")
+        parser.add_argument("--capacity", type=int, default=100, help="Messages held per channel")
+        parser.add_argument("--expiry", type=float, default=60, help="Seconds a message is held when its sender sets none")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if os.path.exists(path):
+            os.unlink(path)
+        self.stdout.write(f"Broker listening on {path}")
+        try:
+            asyncio.run(Broker(capacity=options["capacity"], expiry=options["expiry"]).serve(path))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
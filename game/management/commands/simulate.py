@@ -0,0 +1,240 @@
+import random
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from game import batch, reference
+from game.engine import Board
+from game.metrics import percentile
+from game.protocol import COLOR_NAMES
+from game.rng import GemRNG
+from game.scores import cascade_points
+
+
+def cleared_by(board, a, b):
+    """How many gems a swap clears before any cascade."""
+    cells = board.cells
+    cells[a], cells[b] = cells[b], cells[a]
+    count = len(board.find_matches_around((a, b)))
+    cells[a], cells[b] = cells[b], cells[a]
+    return count
+
+
+def play(board, a, b, rng):
+    """Applies a legal swap the way Room.apply_swap does.
+
+    Returns the cascade steps and the board to play next, which is a new one
+    if the move left no legal moves.
+    """
+    cells = board.cells
+    cells[a], cells[b] = cells[b], cells[a]
+    matches = board.find_matches_around((a, b))
+    board.invalidate_hint((a, b))
+    steps = board.cascade(matches, rng)
+    if not board.has_valid_moves():
+        return steps, Board.generate(board.width, board.height, rng, kinds=board.kinds)
+    return steps, board
+
+
+def replay_mismatch(rows, width, a, b, steps, after):
+    """Replays an engine move with the reference functions.
+
+    The reference clears, drops and refills the same cells with the gems the
+    engine spawned. Returns a description of the first difference, or None.
+    """
+    reference.swap_gems(rows, a % width, a // width, b % width, b // width)
+    for level, step in enumerate(steps):
+        expected = {divmod(i, width) for i in step.cleared}
+        if reference.find_matches(rows) != expected:
+            return f"level {level}: matches differ"
+        reference.clear_matches(rows, expected)
+        reference.apply_gravity(rows)
+        empty = {(y, x) for y, row in enumerate(rows) for x, gem in enumerate(row) if gem is None}
+        if empty != {divmod(i, width) for i, _ in step.spawns}:
+            return f"level {level}: gravity left different cells empty"
+        for i, gem in step.spawns:
+            y, x = divmod(i, width)
+            rows[y][x] = COLOR_NAMES[gem]
+    if reference.find_matches(rows):
+        return "the cascade stopped with matches on the board"
+    if after is not None:
+        if rows != after.to_colors():
+            return "final boards differ"
+        if not reference.has_valid_moves(rows):
+            return "engine found a move the reference does not"
+    elif reference.has_valid_moves(rows):
+        return "engine reshuffled a board the reference can still play"
+    return None
+
+
+def batch_mismatch(boards, moves=True):
+    """Checks the batch engine against the reference and the engine; returns the first difference.
+
+    Pass ``moves=False`` for boards with empty cells, which have no meaningful moves.
+    """
+    np = batch.np
+    matches = batch.match_mask(boards)
+    playable = batch.has_valid_moves(boards)
+    collapsed = batch.collapse(boards)
+    right, down = batch.move_masks(boards)
+    for n, cells in enumerate(boards):
+        rows = [[COLOR_NAMES[gem] for gem in row] for row in cells]
+        if {(int(y), int(x)) for y, x in zip(*np.nonzero(matches[n]))} != reference.find_matches(rows):
+            return f"board {n}: matches differ"
+        if moves and bool(playable[n]) != reference.has_valid_moves(rows):
+            return f"board {n}: has_valid_moves differs"
+        board = Board(cells.shape[1], cells.shape[0], cells.tobytes())
+        if moves:
+            w = board.width
+            found = {(int(y) * w + int(x), int(y) * w + int(x) + 1) for y, x in zip(*np.nonzero(right[n]))}
+            found |= {(int(y) * w + int(x), (int(y) + 1) * w + int(x)) for y, x in zip(*np.nonzero(down[n]))}
+            if found != board.legal_moves():
+                return f"board {n}: legal moves differ"
+        reference.apply_gravity(rows)
+        if rows != [[COLOR_NAMES[gem] for gem in row] for row in collapsed[n]]:
+            return f"board {n}: gravity differs"
+    return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Plays seeded games against the board engine without Channels or a database "
+        "and reports throughput, cascade depths, shuffles and scores."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=100)
+        parser.add_argument("--moves", type=int, default=100, help="Moves per game")
+        parser.add_argument("--policy", choices=["random", "greedy"], default="random",
+                            help="random plays any legal move; greedy plays the one clearing the most gems")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--compare", action="store_true",
+                            help="Check every move against the reference consumer logic and time both")
+        parser.add_argument("--batch", type=int, default=0,
+                            help="Play this many games at a time with the NumPy batch engine (random policy only)")
+
+    def handle(self, *args, **options):
+        if options["batch"]:
+            return self.handle_batch(options)
+        games, moves_per_game, policy = options["games"], options["moves"], options["policy"]
+        compare = options["compare"]
+        # Boards and refills draw from a GemRNG, as rooms do
+        board_rng = GemRNG(options["seed"])
+        policy_rng = random.Random(options["seed"] + 1)
+        reference_rng = random.Random(options["seed"] + 2)
+
+        depths = Counter()
+        scores = []
+        shuffles = moves = 0
+        engine_time = reference_time = 0.0
+        mismatches = []
+
+        for game in range(games):
+            board = Board.generate(rng=board_rng)
+            score = 0
+            for _ in range(moves_per_game):
+                choices = sorted(board.legal_moves())
+                if policy == "greedy":
+                    a, b = max(choices, key=lambda move: cleared_by(board, *move))
+                else:
+                    a, b = policy_rng.choice(choices)
+
+                if compare:
+                    before = board.to_colors()
+                    rows = board.to_colors()
+                    start = time.perf_counter()
+                    w = board.width
+                    reference.swap_gems(rows, a % w, a // w, b % w, b // w)
+                    reference.cascade(rows, reference_rng)
+                    reference.has_valid_moves(rows)
+                    reference_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                steps, after = play(board, a, b, board_rng)
+                engine_time += time.perf_counter() - start
+
+                if compare:
+                    problem = replay_mismatch(before, board.width, a, b, steps, board if after is board else None)
+                    if problem:
+                        mismatches.append(f"game {game}, move {moves}: {problem}")
+
+                moves += 1
+                depths[len(steps)] += 1
+                score += cascade_points([len(step.cleared) for step in steps])[0]
+                if after is not board:
+                    shuffles += 1
+                board = after
+            scores.append(score)
+
+        self.report(options, moves, engine_time, depths, shuffles, scores)
+        if compare:
+            self.stdout.write(
+                f"reference: {moves / reference_time:.0f} moves/sec, "
+                f"engine is {reference_time / engine_time:.1f}x faster"
+            )
+            if mismatches:
+                raise CommandError(
+                    f"{len(mismatches)} of {moves} moves differ from the reference:\n" + "\n".join(mismatches[:10])
+                )
+            self.stdout.write(f"all {moves} moves match the reference")
+
+    def handle_batch(self, options):
+        if batch.np is None:
+            raise CommandError("--batch needs NumPy")
+        if options["policy"] != "random":
+            raise CommandError("--batch only plays the random policy")
+        np = batch.np
+        rng = np.random.default_rng(options["seed"])
+        moves_per_game = options["moves"]
+
+        depths = Counter()
+        scores = []
+        shuffles = moves = 0
+        engine_time = 0.0
+        remaining = options["games"]
+        while remaining:
+            n = min(options["batch"], remaining)
+            remaining -= n
+            boards = batch.generate(n, rng=rng)
+            totals = np.zeros(n, dtype=np.int64)
+            for _ in range(moves_per_game):
+                chosen = batch.random_moves(boards, rng)
+                start = time.perf_counter()
+                boards, levels = batch.cascade(batch.swap(boards, *chosen), rng)
+                stuck = ~batch.has_valid_moves(boards)
+                if stuck.any():
+                    boards[stuck] = batch.generate(int(stuck.sum()), rng=rng)
+                engine_time += time.perf_counter() - start
+                shuffles += int(stuck.sum())
+                totals += batch.cascade_points(levels)
+                for depth, count in enumerate(np.bincount((levels > 0).sum(axis=1))):
+                    if count:
+                        depths[depth] += int(count)
+            moves += n * moves_per_game
+            scores.extend(totals.tolist())
+
+        self.report(options, moves, engine_time, depths, shuffles, scores, "the batch engine")
+        if options["compare"]:
+            # Few gem types and some empty cells give plenty of runs and holes
+            samples = rng.integers(0, 4, size=(1000, 8, 8), dtype=np.uint8)
+            samples[:500] = batch.random_boards(500, rng=rng)
+            problem = batch_mismatch(samples[:500]) or batch_mismatch(samples[500:], moves=False)
+            if problem:
+                raise CommandError(f"The batch engine differs from the reference: {problem}")
+            self.stdout.write(f"the batch engine matches the reference on {len(samples)} boards")
+
+    def report(self, options, moves, engine_time, depths, shuffles, scores, engine="the engine"):
+        self.stdout.write(
+            f"{options['games']} {options['policy']} games of {options['moves']} moves (seed {options['seed']}): "
+            f"{moves / engine_time:.0f} moves/sec in {engine}"
+        )
+        self.stdout.write("cascade depth: " + ", ".join(
+            f"{depth}: {count} ({count / moves:.1%})" for depth, count in sorted(depths.items())
+        ))
+        self.stdout.write(f"shuffles: {shuffles} ({shuffles * 1000 / moves:.1f} per 1000 moves)")
+        scores.sort()
+        self.stdout.write(
+            f"score per game: mean {sum(scores) / len(scores):.0f}, min {scores[0]}, "
+            f"median {percentile(scores, 0.5)}, p90 {percentile(scores, 0.9)}, max {scores[-1]}"
+        )
@@ -0,0 +1,121 @@
+import time
+
+from django.conf import settings
+
+# Upper bounds in seconds of the stage timing histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def percentile(samples, fraction):
+    """The sample below which ``fraction`` of them fall (nearest rank)."""
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Counters and per-stage timings for the game, rendered for Prometheus.
+
+    When disabled, ``inc`` returns at once and ``timer`` hands back a shared
+    do-nothing context manager, so instrumented code pays one attribute check.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        # stage -> [count per bucket..., count over the last bucket, total seconds]
+        self.stages = {}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def timer(self, stage):
+        """Context manager that records how long its block took under ``stage``."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        row = self.stages.get(stage)
+        if row is None:
+            row = self.stages[stage] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for k, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                row[k] += 1
+                break
+        else:
+            row[len(BUCKETS)] += 1
+        row[-1] += seconds
+
+    def render(self, gauges=()):
+        """Prometheus text format for the counters, stage timings and ``gauges``.
+
+        ``gauges`` is an iterable of (name, labels dict, value).
+        """
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(f"game_{name}", "counter")
+            lines.append(f"game_{name}{_labels(labels)} {value}")
+
+        for stage, row in sorted(self.stages.items()):
+            header("game_stage_seconds", "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, row):
+                cumulative += count
+                lines.append(f'game_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            cumulative += row[len(BUCKETS)]
+            lines.append(f'game_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+            lines.append(f'game_stage_seconds_sum{{stage="{stage}"}} {row[-1]:.6f}')
+            lines.append(f'game_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        for name, labels, value in gauges:
+            header(f"game_{name}", "gauge")
+            lines.append(f"game_{name}{_labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(getattr(settings, "GAME_METRICS", False))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0002_gameboard_score_gameplayer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameboard',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
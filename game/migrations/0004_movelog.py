@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0003_gameboard_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MoveLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_version', models.PositiveIntegerField()),
+                ('end_version', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('board', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log', to='game.gameboard')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['board', 'start_version'], name='game_movelo_board_i_d68e0a_idx')],
+            },
+        ),
+    ]
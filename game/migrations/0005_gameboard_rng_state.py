@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0004_movelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameboard',
+            name='rng_state',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
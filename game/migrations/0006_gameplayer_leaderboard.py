@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0005_gameboard_rng_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayer',
+            name='updated',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='gameplayer',
+            name='score',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
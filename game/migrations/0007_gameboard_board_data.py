@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+# The storage format as it was when this migration was written, kept here
+# so later changes to game.engine and game.protocol can't change what it does
+GEM_TYPES = ["red", "blue", "green", "yellow", "purple", "orange", "white"]
+GEM_CODES = {color: code for code, color in enumerate(GEM_TYPES, start=1)}
+BOARD_PACKED = 1
+BOARD_BYTES = 2
+BOARD_PACKED_KINDS = 3
+
+
+def pack_colors(rows):
+    # Format, width and height bytes, then gem codes at 3 bits each, the
+    # first cell in the lowest bits
+    height = len(rows)
+    width = len(rows[0]) if height else 0
+    packed = 0
+    for i, color in enumerate(color for row in rows for color in row):
+        packed |= (GEM_CODES.get(color, 0) if color else 0) << (3 * i)
+    return bytes((BOARD_PACKED, width, height)) + packed.to_bytes((width * height * 3 + 7) // 8, 'little')
+
+
+def unpack_colors(data):
+    fmt, width, height = data[0], data[1], data[2]
+    body = data[3:]
+    if fmt == BOARD_BYTES:
+        cells = list(body[:width * height])
+    elif fmt in (BOARD_PACKED, BOARD_PACKED_KINDS):
+        if fmt == BOARD_PACKED_KINDS:
+            body = body[1:]
+        packed = int.from_bytes(body, 'little')
+        cells = [(packed >> (3 * i)) & 7 for i in range(width * height)]
+    else:
+        raise ValueError(f"Unknown stored board format {fmt}")
+    names = [None] + GEM_TYPES
+    return [
+        [names[code] if code < len(names) else None for code in cells[y * width:(y + 1) * width]]
+        for y in range(height)
+    ]
+
+
+def pack_boards(apps, schema_editor):
+    GameBoard = apps.get_model('game', 'GameBoard')
+    for game_board in GameBoard.objects.only('id', 'board_state').iterator():
+        if not game_board.board_state:
+            continue
+        GameBoard.objects.filter(id=game_board.id).update(board_data=pack_colors(game_board.board_state))
+
+
+def unpack_boards(apps, schema_editor):
+    GameBoard = apps.get_model('game', 'GameBoard')
+    for game_board in GameBoard.objects.exclude(board_data=None).only('id', 'board_data').iterator():
+        GameBoard.objects.filter(id=game_board.id).update(
+            board_state=unpack_colors(bytes(game_board.board_data))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0006_gameplayer_leaderboard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameboard',
+            name='board_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(pack_boards, unpack_boards),
+        migrations.RemoveField(
+            model_name='gameboard',
+            name='board_state',
+        ),
+    ]
@@ -1,27 +1,70 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
-import random
-
-GEM_TYPES = ["red", "blue", "green", "yellow", "purple", "orange", "white"]
+from .engine import Board, GEM_TYPES
+from .protocol import pack_board, unpack_board
 
 class GameBoard(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    board_state = models.JSONField(default=list)
+    # The board packed by game.protocol.pack_board: 27 bytes for 8x8
+    board_data = models.BinaryField(null=True, blank=True)
+    score = models.IntegerField(default=0)
+    version = models.PositiveIntegerField(default=0)
+    # The room's GemRNG state as of ``version``; refills and reshuffles draw from it
+    rng_state = models.BinaryField(null=True, blank=True)
     last_updated = models.DateTimeField(auto_now=True)
 
+    @property
+    def board(self):
+        """The stored board as an engine Board, or None if there is none yet."""
+        return unpack_board(bytes(self.board_data)) if self.board_data else None
+
+    @board.setter
+    def board(self, board):
+        self.board_data = pack_board(board)
+
+    @property
+    def board_state(self):
+        """The board as rows of color names, as it was stored before it was packed."""
+        board = self.board
+        return board.to_colors() if board is not None else []
+
+    @board_state.setter
+    def board_state(self, rows):
+        self.board = Board.from_colors(rows)
+
     def generate_board(self):
-        return [[random.choice(GEM_TYPES) for _ in range(8)] for _ in range(8)]
+        return Board.generate().to_colors()
 
     def save(self, *args, **kwargs):
-        if not self.board_state:
-            self.board_state = self.generate_board()
+        if not self.board_data:
+            self.board = Board.generate()
         super().save(*args, **kwargs)
 
 class GamePlayer(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    score = models.IntegerField(default=0)
+    score = models.IntegerField(default=0, db_index=True)
+    # When points were last added; leaderboards catch up on rows changed since
+    updated = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def update_score(self, points):
-        self.score += points
-        self.save()
+        GamePlayer.add_score(self.user_id, points)
+        self.refresh_from_db(fields=['score'])
+
+    @classmethod
+    def add_score(cls, user_id, points):
+        # A single atomic increment, safe against concurrent writers
+        cls.objects.filter(user_id=user_id).update(score=models.F('score') + points, updated=timezone.now())
+
+class MoveLog(models.Model):
+    """One appended stretch of a board's move log, covering versions after
+    ``start_version`` up to ``end_version`` (see game/movelog.py)."""
+    board = models.ForeignKey(GameBoard, on_delete=models.CASCADE, related_name='log')
+    start_version = models.PositiveIntegerField()
+    end_version = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['board', 'start_version'])]
@@ -0,0 +1,167 @@
+"""Compact append-only move logs, from which any room's game can be replayed.
+
+A log is a stream of records:
+  BOARD: width, height, packed cells; the board as of the current version,
+         written when a room is loaded and whenever it is reshuffled
+  RNG:   the room's 8-byte GemRNG state, written after the BOARD a room
+         is loaded with
+  KINDS: the number of gem kinds the BOARD after it plays with, written
+         only for boards with fewer than all of them
+  MOVE:  the two swapped flat indices, then the gems refills drew, in order
+Each applied MOVE advances the version by one. Gems are packed at 3 bits
+each as in the binary protocol. Rooms append records as they play and store
+them as MoveLog segments alongside their write-behind board flushes.
+
+Recorded gems make a log replayable on its own; with the RNG state known,
+replays also check them, and reshuffled boards, against what the room's
+RNG must have produced.
+"""
+import struct
+
+from .engine import MAX_GEM_KINDS, Board
+from .protocol import pack_cells, unpack_cells
+from .rng import GemRNG
+
+RECORD_BOARD = 1
+RECORD_MOVE = 2
+RECORD_RNG = 3
+RECORD_KINDS = 4
+
+_MOVE = struct.Struct('!BHHH')
+_BOARD = struct.Struct('!BBB')
+
+
+class LogError(ValueError):
+    """The log does not replay: it is corrupt, or records a move the rules don't allow."""
+
+
+def encode_board(board):
+    record = _BOARD.pack(RECORD_BOARD, board.width, board.height) + pack_cells(board.cells)
+    if board.kinds != MAX_GEM_KINDS:
+        return bytes((RECORD_KINDS, board.kinds)) + record
+    return record
+
+
+def encode_rng(rng):
+    return bytes((RECORD_RNG,)) + rng.getstate()
+
+
+def encode_move(a, b, draws):
+    return _MOVE.pack(RECORD_MOVE, a, b, len(draws)) + pack_cells(draws)
+
+
+def move_draws(steps):
+    """The gems a cascade's refills drew, in the order the RNG produced them."""
+    return [gem for step in steps for _, gem in step.spawns]
+
+
+def read_records(data):
+    """Yields ('board', Board), ('rng', state) and ('move', a, b, draws) records from log bytes."""
+    pos = 0
+    size = len(data)
+    kinds = MAX_GEM_KINDS
+    while pos < size:
+        kind = data[pos]
+        if kind == RECORD_BOARD:
+            _, width, height = _BOARD.unpack_from(data, pos)
+            pos += _BOARD.size
+            count = width * height
+            end = pos + (count * 3 + 7) // 8
+            yield 'board', Board(width, height, unpack_cells(data[pos:end], count), kinds)
+            kinds = MAX_GEM_KINDS
+        elif kind == RECORD_KINDS:
+            end = pos + 2
+            if end <= size:
+                kinds = data[pos + 1]
+        elif kind == RECORD_MOVE:
+            _, a, b, count = _MOVE.unpack_from(data, pos)
+            pos += _MOVE.size
+            end = pos + (count * 3 + 7) // 8
+            yield 'move', a, b, unpack_cells(data[pos:end], count)
+        elif kind == RECORD_RNG:
+            end = pos + 9
+            yield 'rng', bytes(data[pos + 1:end])
+        else:
+            raise LogError(f"Unknown record type {kind} at byte {pos}")
+        if end > size:
+            raise LogError("The log ends in the middle of a record")
+        pos = end
+
+
+class _Draws:
+    """Stands in for the RNG during a replay, handing back the recorded gems in order."""
+
+    def __init__(self, drawn):
+        self.drawn = drawn
+        self.used = 0
+
+    def randint(self, low, high):
+        if self.used == len(self.drawn):
+            raise LogError("The cascade needs more gems than were recorded")
+        gem = self.drawn[self.used]
+        self.used += 1
+        return gem
+
+
+def replay(segments, version=0):
+    """Replays log segments and yields (version, board) after every record.
+
+    ``segments`` are log byte strings in order and ``version`` is the version
+    the first one starts at. The board yielded is reused; copy it to keep it.
+    Raises LogError if a move was not legal on the board it was made on, its
+    recorded refills don't fit the cascade it caused or don't match the
+    room's RNG, a reshuffle follows a playable board (one with moves and no
+    runs) or isn't the one the RNG generates, or a segment picks up from a
+    board or RNG state other than the one the log left off at.
+    """
+    board = rng = None
+    for data in segments:
+        # A room's records start with a checkpoint of where it resumed from:
+        # its board and RNG state, ahead of any move
+        checkpoint = True
+        resumed = False
+        for record in read_records(data):
+            kind = record[0]
+            if kind == 'rng':
+                if checkpoint and rng is not None and rng.getstate() != record[1]:
+                    raise LogError(f"The RNG at version {version} was changed outside of play")
+                rng = GemRNG.from_state(record[1])
+                continue
+            if kind == 'board':
+                new = record[1]
+                if checkpoint and not resumed:
+                    resumed = True
+                    if board is not None and new.cells != board.cells:
+                        raise LogError(f"The board at version {version} was changed outside of play")
+                else:
+                    # Rooms reshuffle boards left without moves, and boards
+                    # loaded with runs or without moves
+                    if board.has_valid_moves() and not board.find_matches():
+                        raise LogError(f"The board at version {version} was reshuffled while it had moves")
+                    if rng is not None:
+                        expected = Board.generate(new.width, new.height, rng, kinds=new.kinds)
+                        if expected.cells != new.cells:
+                            raise LogError(f"The reshuffle at version {version} is not the room RNG's board")
+                board = new
+                yield version, board
+                continue
+            checkpoint = False
+            _, a, b, draws = record
+            if board is None:
+                raise LogError(f"Move at version {version} comes before any board")
+            if (min(a, b), max(a, b)) not in board.legal_moves():
+                raise LogError(f"Move {a}-{b} at version {version} is not legal")
+            cells = board.cells
+            cells[a], cells[b] = cells[b], cells[a]
+            matches = board.find_matches_around((a, b))
+            board.invalidate_hint((a, b))
+            if rng is not None:
+                if move_draws(board.cascade(matches, rng)) != draws:
+                    raise LogError(f"Move at version {version} recorded refills the room RNG did not draw")
+            else:
+                recorded = _Draws(draws)
+                board.cascade(matches, recorded)
+                if recorded.used != len(draws):
+                    raise LogError(f"Move at version {version} recorded more gems than its cascade drew")
+            version += 1
+            yield version, board
@@ -0,0 +1,414 @@
+import functools
+import json
+import struct
+
+from .engine import GEM_TYPES, MAX_GEM_KINDS, Board
+
+# Clients connecting with ?mode=delta get versioned diffs instead of full boards,
+# plus a full snapshot every SNAPSHOT_INTERVAL versions. ?mode=binary carries
+# the same messages as delta, packed into binary frames (see encode_binary).
+PROTOCOLS = ('json', 'delta', 'binary')
+SNAPSHOT_INTERVAL = 50
+
+COLOR_NAMES = [None] + GEM_TYPES
+
+
+def hint_coords(board):
+    """The board's cached legal move as [x1, y1, x2, y2], or None if there is none."""
+    hint = board.hint()
+    if hint is None:
+        return None
+    w = board.width
+    return [hint[0] % w, hint[0] // w, hint[1] % w, hint[1] // w]
+
+
+def serialize_steps(steps, names=None):
+    # Gems are sent as color names, or as their small int codes without names
+    return [
+        {
+            'clear': step.cleared,
+            'fall': step.falls,
+            'spawn': [[i, names[gem] if names else gem] for i, gem in step.spawns],
+        }
+        for step in steps
+    ]
+
+
+def move_payload(protocol, room, move, player_id):
+    """Builds the message announcing a move in the given protocol."""
+    if protocol != 'json':
+        payload = {
+            'v': room.version,
+            'base': room.version - 1,
+            'swap': move['swap'],
+            'steps': serialize_steps(move['steps']),
+            'shuffled': move['shuffled'],
+        }
+        if room.version % SNAPSHOT_INTERVAL == 0:
+            payload['cells'] = list(room.board.cells)
+            payload['width'] = room.board.width
+        else:
+            payload['d'] = move['diff']
+    else:
+        payload = {
+            'version': room.version,
+            'swap': move['swap'],
+            'steps': serialize_steps(move['steps'], COLOR_NAMES),
+            'shuffled': move['shuffled'],
+            'board': room.board.to_colors(),
+        }
+    payload['hint'] = hint_coords(room.board)
+    payload['player_id'] = player_id
+    return payload
+
+
+def tick_payload(protocol, room, base, diff):
+    """Builds the message carrying every move of one broadcast at once.
+
+    Delta clients get the [index, gem, ...] changes from version ``base`` to
+    the room's current one; json clients get the board, which is all their
+    move messages carry between versions anyway.
+    """
+    if protocol == 'json':
+        return board_payload(protocol, room)
+    return {'v': room.version, 'base': base, 'd': diff, 'hint': hint_coords(room.board)}
+
+
+def board_payload(protocol, room, rejected=False):
+    """Builds a full board message, or an empty diff for a rejected delta move."""
+    if protocol != 'json':
+        if rejected:
+            # Nothing changed; an empty diff at the current version undoes
+            # the client's optimistic swap
+            payload = {'v': room.version, 'base': room.version, 'd': []}
+        else:
+            payload = {'v': room.version, 'cells': list(room.board.cells), 'width': room.board.width}
+    else:
+        payload = {'version': room.version, 'board': room.board.to_colors()}
+    payload['hint'] = hint_coords(room.board)
+    return payload
+
+
+def encode(protocol, payload, mine=False):
+    """Encodes a message as JSON text, or as bytes for the binary protocol."""
+    if protocol == 'binary':
+        return encode_binary(payload, mine)
+    return json.dumps(payload)
+
+
+# Binary frames. Server frames start with a header of type, flags and version:
+#   SNAPSHOT: width, height, [hint], [score], [seq], packed cells
+#   MOVE:     swap x1 y1 x2 y2, [hint], [score], [seq], steps, then the
+#             [index, gem] changes, or width, height and packed cells if FULL
+#   REJECT:   [hint], [score], [seq], reason; the base version is the version itself
+#   DROPPED:  [seq]; a move refused without looking at the board, version 0
+#   DIFF:     u32 base version, [hint], then the [index, gem] changes since it
+# Optional parts are present when their flag is set. Cells are packed at
+# 3 bits each, least significant bits first. Client frames are a MOVE_OP with
+# x1 y1 x2 y2, a u32 seq and optionally the u32 board version the move was
+# made on, a lone RESYNC_OP byte, or an ACK_OP with the u32 board version
+# the client has applied.
+
+FRAME_SNAPSHOT = 1
+FRAME_MOVE = 2
+FRAME_REJECT = 3
+FRAME_DROPPED = 4
+FRAME_DIFF = 5
+
+FLAG_MINE = 1
+FLAG_SHUFFLED = 2
+FLAG_HINT = 4
+FLAG_SCORE = 8
+FLAG_SEQ = 16
+FLAG_FULL = 32
+
+MOVE_OP = 1
+RESYNC_OP = 2
+ACK_OP = 3
+
+# Why a move was rejected, by its code in REJECT frames; 0 is unknown
+REJECT_REASONS = (None, 'illegal', 'stale')
+
+_HEADER = struct.Struct('!BBI')
+_QUAD = struct.Struct('!BBBB')
+_SCORE = struct.Struct('!iH')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_PAIR = struct.Struct('!HH')
+_CHANGE = struct.Struct('!HB')
+_CLIENT_MOVE = struct.Struct('!BBBBBI')
+_CLIENT_MOVE_AT = struct.Struct('!BBBBBII')
+_CLIENT_ACK = struct.Struct('!BI')
+_STORED_BOARD = struct.Struct('!BBB')
+# Packing passes as (lane bytes, bits kept, bits moved down, shift): pairs
+# of gems, then fours, then eights come together in the bottom of each lane
+_PACK_STEPS = ((2, 0x0007, 0x0038, 5), (4, 0x0000003F, 0x00000FC0, 10), (8, 0xFFF, 0xFFF000, 20))
+
+# Stored board formats, the first byte of a packed board. Boards whose gem
+# codes fit in 3 bits are packed; any other board is stored a byte per cell.
+# Boards with fewer than MAX_GEM_KINDS kinds are packed with their count
+# after the height.
+BOARD_PACKED = 1
+BOARD_BYTES = 2
+BOARD_PACKED_KINDS = 3
+
+
+def _lanes(pattern, groups):
+    # ``pattern`` repeated over every 8-cell group, as one integer
+    return int.from_bytes(pattern * groups, 'little')
+
+
+@functools.lru_cache(maxsize=64)
+def _masks(groups):
+    return tuple(
+        (_lanes(low.to_bytes(size, 'little'), groups * 8 // size),
+         _lanes(high.to_bytes(size, 'little'), groups * 8 // size), shift)
+        for size, low, high, shift in _PACK_STEPS
+    )
+
+
+def pack_cells(cells):
+    """Packs gem codes (0-7) at 3 bits per cell.
+
+    The cells are read as one integer with a gem in every byte, and three
+    mask-and-shift passes pull each run of eight gems into the low 24 bits
+    of its 8-byte lane; the work is a fixed number of passes over the board
+    rather than a step per cell.
+    """
+    count = len(cells)
+    groups = (count + 7) // 8
+    x = int.from_bytes(bytes(cells) + bytes(groups * 8 - count), 'little')
+    for low, high, shift in _masks(groups):
+        x = (x & low) | ((x >> shift) & high)
+    lanes = x.to_bytes(groups * 8, 'little')
+    out = bytearray(groups * 3)
+    for k in range(3):
+        out[k::3] = lanes[k::8]
+    return bytes(out[:(count * 3 + 7) // 8])
+
+
+def unpack_cells(data, count):
+    groups = (count + 7) // 8
+    data = bytes(data[:groups * 3]).ljust(groups * 3, b'\0')
+    lanes = bytearray(groups * 8)
+    for k in range(3):
+        lanes[k::8] = data[k::3]
+    x = int.from_bytes(lanes, 'little')
+    for low, high, shift in reversed(_masks(groups)):
+        x = (x & low) | ((x & high) << shift)
+    return list(x.to_bytes(groups * 8, 'little')[:count])
+
+
+def pack_board(board):
+    """Packs a board for storage: format, width, height, then its cells."""
+    cells = board.cells
+    if max(cells, default=0) >= 8:
+        return _STORED_BOARD.pack(BOARD_BYTES, board.width, board.height) + bytes(cells)
+    if board.kinds != MAX_GEM_KINDS:
+        header = _STORED_BOARD.pack(BOARD_PACKED_KINDS, board.width, board.height) + bytes((board.kinds,))
+        return header + pack_cells(cells)
+    return _STORED_BOARD.pack(BOARD_PACKED, board.width, board.height) + pack_cells(cells)
+
+
+def unpack_board(data):
+    fmt, width, height = _STORED_BOARD.unpack_from(data)
+    body = data[_STORED_BOARD.size:]
+    if fmt == BOARD_PACKED:
+        return Board(width, height, unpack_cells(body, width * height))
+    if fmt == BOARD_PACKED_KINDS:
+        return Board(width, height, unpack_cells(body[1:], width * height), body[0])
+    if fmt == BOARD_BYTES:
+        return Board(width, height, body)
+    raise ValueError(f"Unknown stored board format {fmt}")
+
+
+def encode_binary(payload, mine=False):
+    """Packs a delta-mode payload into a binary frame."""
+    flags = FLAG_MINE if mine else 0
+    if payload.get('hint'):
+        flags |= FLAG_HINT
+    if 'score' in payload:
+        flags |= FLAG_SCORE
+    if payload.get('seq') is not None:
+        flags |= FLAG_SEQ
+    if payload.get('shuffled'):
+        flags |= FLAG_SHUFFLED
+
+    if 'swap' in payload:
+        kind = FRAME_MOVE
+        if 'cells' in payload:
+            flags |= FLAG_FULL
+    elif 'cells' in payload:
+        kind = FRAME_SNAPSHOT
+    elif payload.get('rejected') and 'v' in payload:
+        kind = FRAME_REJECT
+    elif 'd' in payload:
+        kind = FRAME_DIFF
+    elif 'v' in payload:
+        kind = FRAME_REJECT
+    else:
+        kind = FRAME_DROPPED
+
+    parts = [_HEADER.pack(kind, flags, payload.get('v', 0))]
+    if kind == FRAME_SNAPSHOT:
+        cells = payload['cells']
+        width = payload['width']
+        parts.append(bytes((width, len(cells) // width)))
+    elif kind == FRAME_MOVE:
+        parts.append(_QUAD.pack(*payload['swap']))
+    elif kind == FRAME_DIFF:
+        parts.append(_U32.pack(payload['base']))
+    if flags & FLAG_HINT:
+        parts.append(_QUAD.pack(*payload['hint']))
+    if flags & FLAG_SCORE:
+        parts.append(_SCORE.pack(payload['score'], int(payload.get('combo_multiplier', 1.0) * 10)))
+    if flags & FLAG_SEQ:
+        parts.append(_U32.pack(payload['seq'] & 0xffffffff))
+
+    if kind == FRAME_SNAPSHOT:
+        parts.append(pack_cells(payload['cells']))
+    elif kind == FRAME_REJECT:
+        reason = payload.get('reason')
+        code = REJECT_REASONS.index(reason) if reason in REJECT_REASONS else 0
+        parts.append(bytes((code,)))
+    elif kind == FRAME_MOVE:
+        steps = payload['steps']
+        parts.append(bytes((len(steps),)))
+        for step in steps:
+            parts.append(_U16.pack(len(step['clear'])))
+            parts.extend(_U16.pack(i) for i in step['clear'])
+            parts.append(_U16.pack(len(step['fall'])))
+            parts.extend(_PAIR.pack(src, dst) for src, dst in step['fall'])
+            parts.append(_U16.pack(len(step['spawn'])))
+            parts.extend(_CHANGE.pack(i, gem) for i, gem in step['spawn'])
+        if flags & FLAG_FULL:
+            cells = payload['cells']
+            width = payload['width']
+            parts.append(bytes((width, len(cells) // width)))
+            parts.append(pack_cells(cells))
+    if kind == FRAME_DIFF or (kind == FRAME_MOVE and not flags & FLAG_FULL):
+        diff = payload['d']
+        parts.append(_U16.pack(len(diff) // 2))
+        parts.extend(_CHANGE.pack(diff[k], diff[k + 1]) for k in range(0, len(diff), 2))
+    return b''.join(parts)
+
+
+def decode_binary(data):
+    """Unpacks a server frame into the dict a delta-mode client would have received.
+
+    Frames from the mover also carry ``mine``; rejected moves carry ``rejected``,
+    and moves dropped unseen carry nothing else but their ``seq``.
+    """
+    kind, flags, version = _HEADER.unpack_from(data)
+    pos = _HEADER.size
+    payload = {'v': version}
+    if flags & FLAG_MINE:
+        payload['mine'] = True
+    if kind == FRAME_SNAPSHOT:
+        width, height = data[pos], data[pos + 1]
+        pos += 2
+    elif kind == FRAME_MOVE:
+        payload['swap'] = list(_QUAD.unpack_from(data, pos))
+        payload['shuffled'] = bool(flags & FLAG_SHUFFLED)
+        pos += _QUAD.size
+    elif kind == FRAME_DIFF:
+        payload['base'] = _U32.unpack_from(data, pos)[0]
+        pos += _U32.size
+    payload['hint'] = None
+    if flags & FLAG_HINT:
+        payload['hint'] = list(_QUAD.unpack_from(data, pos))
+        pos += _QUAD.size
+    if flags & FLAG_SCORE:
+        score, combo = _SCORE.unpack_from(data, pos)
+        payload['score'] = score
+        payload['combo_multiplier'] = combo / 10
+        pos += _SCORE.size
+    if flags & FLAG_SEQ:
+        payload['seq'] = _U32.unpack_from(data, pos)[0]
+        pos += _U32.size
+
+    def read_cells(width, height):
+        nonlocal pos
+        count = width * height
+        size = (count * 3 + 7) // 8
+        cells = unpack_cells(data[pos:pos + size], count)
+        pos += size
+        return cells
+
+    if kind == FRAME_SNAPSHOT:
+        payload['width'] = width
+        payload['cells'] = read_cells(width, height)
+    elif kind == FRAME_MOVE:
+        payload['base'] = version - 1
+        steps = []
+        levels = data[pos]
+        pos += 1
+        for _ in range(levels):
+            step = {}
+            for key, item in (('clear', _U16), ('fall', _PAIR), ('spawn', _CHANGE)):
+                count = _U16.unpack_from(data, pos)[0]
+                pos += _U16.size
+                values = [item.unpack_from(data, pos + k * item.size) for k in range(count)]
+                pos += count * item.size
+                step[key] = [v[0] for v in values] if item is _U16 else [list(v) for v in values]
+            steps.append(step)
+        payload['steps'] = steps
+        if flags & FLAG_FULL:
+            width, height = data[pos], data[pos + 1]
+            pos += 2
+            payload['width'] = width
+            payload['cells'] = read_cells(width, height)
+    if kind == FRAME_DIFF or (kind == FRAME_MOVE and not flags & FLAG_FULL):
+        count = _U16.unpack_from(data, pos)[0]
+        pos += _U16.size
+        diff = []
+        for k in range(count):
+            diff.extend(_CHANGE.unpack_from(data, pos + k * _CHANGE.size))
+        payload['d'] = diff
+    elif kind == FRAME_REJECT:
+        payload['base'] = version
+        payload['d'] = []
+        payload['rejected'] = True
+        code = data[pos] if pos < len(data) else 0
+        payload['reason'] = REJECT_REASONS[code] if code < len(REJECT_REASONS) else None
+    elif kind == FRAME_DROPPED:
+        del payload['v'], payload['hint']
+        payload['rejected'] = True
+        payload['reason'] = 'rate_limited'
+    return payload
+
+
+def encode_client_move(x1, y1, x2, y2, seq, version=None):
+    """Packs a move the way a binary client sends it."""
+    if version is None:
+        return _CLIENT_MOVE.pack(MOVE_OP, x1, y1, x2, y2, seq & 0xffffffff)
+    return _CLIENT_MOVE_AT.pack(MOVE_OP, x1, y1, x2, y2, seq & 0xffffffff, version)
+
+
+def encode_client_ack(version):
+    """Packs the acknowledgement a binary client sends once it has applied a version."""
+    return _CLIENT_ACK.pack(ACK_OP, version)
+
+
+def decode_client_binary(data):
+    """Unpacks a client frame into the dict a JSON client would have sent.
+
+    Raises ValueError for frames that aren't a whole move, resync or ack.
+    """
+    if not data:
+        raise ValueError("Empty binary frame")
+    if data[0] == MOVE_OP:
+        if len(data) == _CLIENT_MOVE_AT.size:
+            _, x1, y1, x2, y2, seq, version = _CLIENT_MOVE_AT.unpack(data)
+            return {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'seq': seq, 'v': version}
+        if len(data) != _CLIENT_MOVE.size:
+            raise ValueError(f"Move frame of {len(data)} bytes")
+        _, x1, y1, x2, y2, seq = _CLIENT_MOVE.unpack(data)
+        return {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'seq': seq}
+    if data[0] == RESYNC_OP:
+        return {'type': 'resync'}
+    if data[0] == ACK_OP:
+        if len(data) != _CLIENT_ACK.size:
+            raise ValueError(f"Ack frame of {len(data)} bytes")
+        return {'type': 'ack', 'v': _CLIENT_ACK.unpack(data)[1]}
+    raise ValueError(f"Unknown binary op {data[0]}")
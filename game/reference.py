@@ -0,0 +1,93 @@
+"""The board logic GameConsumer used before the engine, kept as a baseline.
+
+Boards are lists of rows of color names, with None for an empty cell. The
+simulate command checks the engine against these functions and times both.
+"""
+import random
+
+from .engine import GEM_TYPES
+
+
+def find_matches(board):
+    """Returns every (y, x) in a horizontal or vertical run of three or more."""
+    height, width = len(board), len(board[0])
+    matched = set()
+    for y in range(height):
+        for x in range(width - 2):
+            if board[y][x] and board[y][x] == board[y][x + 1] == board[y][x + 2]:
+                matched |= {(y, x), (y, x + 1), (y, x + 2)}
+    for y in range(height - 2):
+        for x in range(width):
+            if board[y][x] and board[y][x] == board[y + 1][x] == board[y + 2][x]:
+                matched |= {(y, x), (y + 1, x), (y + 2, x)}
+    return matched
+
+
+def swap_gems(board, x1, y1, x2, y2):
+    board[y1][x1], board[y2][x2] = board[y2][x2], board[y1][x1]
+
+
+def has_valid_moves(board):
+    """Tries every swap right and down and rescans the whole board for each."""
+    height, width = len(board), len(board[0])
+    for y in range(height):
+        for x in range(width):
+            if x < width - 1:
+                swap_gems(board, x, y, x + 1, y)
+                found = find_matches(board)
+                swap_gems(board, x, y, x + 1, y)
+                if found:
+                    return True
+            if y < height - 1:
+                swap_gems(board, x, y, x, y + 1)
+                found = find_matches(board)
+                swap_gems(board, x, y, x, y + 1)
+                if found:
+                    return True
+    return False
+
+
+def clear_matches(board, matches):
+    for y, x in matches:
+        board[y][x] = None
+    return bool(matches)
+
+
+def apply_gravity(board):
+    """Drops gems one row per pass until nothing moves."""
+    falling = True
+    while falling:
+        falling = False
+        for y in range(len(board) - 2, -1, -1):
+            for x in range(len(board[0])):
+                if board[y][x] and board[y + 1][x] is None:
+                    board[y + 1][x] = board[y][x]
+                    board[y][x] = None
+                    falling = True
+
+
+def refill_top(board, rng=random):
+    """Fills the empty cells of the top row; returns whether any were empty."""
+    refilled = False
+    for x in range(len(board[0])):
+        if board[0][x] is None:
+            board[0][x] = rng.choice(GEM_TYPES)
+            refilled = True
+    return refilled
+
+
+def cascade(board, rng=random):
+    """Clears matches, drops and refills from the top until the board is stable.
+
+    Returns the number of gems cleared at each level.
+    """
+    cleared = []
+    matches = find_matches(board)
+    while matches:
+        cleared.append(len(matches))
+        clear_matches(board, matches)
+        apply_gravity(board)
+        while refill_top(board, rng):
+            apply_gravity(board)
+        matches = find_matches(board)
+    return cleared
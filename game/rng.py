@@ -0,0 +1,71 @@
+"""A small seeded RNG whose whole state is one 64-bit word.
+
+Rooms keep one each, so their refills and reshuffles can be reproduced
+from a saved state, and saving or restoring it is a single integer. It
+offers the parts of the random.Random interface the engine uses, plus
+``gems`` for drawing many gems from one output.
+"""
+import secrets
+
+_MASK = (1 << 64) - 1
+_GAMMA = 0x9E3779B97F4A7C15
+
+
+class GemRNG:
+    """SplitMix64: a counter stepped by a fixed odd constant, then mixed."""
+
+    __slots__ = ("state",)
+
+    def __init__(self, seed=None):
+        self.state = (secrets.randbits(64) if seed is None else seed) & _MASK
+
+    def getstate(self):
+        return self.state.to_bytes(8, "big")
+
+    def setstate(self, state):
+        self.state = int.from_bytes(state, "big")
+
+    @classmethod
+    def from_state(cls, state):
+        rng = cls.__new__(cls)
+        rng.setstate(state)
+        return rng
+
+    def next64(self):
+        self.state = z = (self.state + _GAMMA) & _MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+        return z ^ (z >> 31)
+
+    def random(self):
+        return (self.next64() >> 11) * (1.0 / (1 << 53))
+
+    def randrange(self, n):
+        # Multiply-shift; the bias is below 2**-50 for any n a board needs
+        return (self.next64() * n) >> 64
+
+    def randint(self, low, high):
+        return low + self.randrange(high - low + 1)
+
+    def choice(self, seq):
+        return seq[self.randrange(len(seq))]
+
+    def gems(self, count, kinds):
+        """Draws ``count`` gems uniformly from 1..kinds.
+
+        Each 64-bit output is cut into chunks just wide enough for ``kinds``
+        and chunks out of range are skipped, so one output covers many cells.
+        """
+        bits = (kinds - 1).bit_length() or 1
+        chunk = (1 << bits) - 1
+        out = []
+        while len(out) < count:
+            word = self.next64()
+            for _ in range(64 // bits):
+                value = word & chunk
+                word >>= bits
+                if value < kinds:
+                    out.append(value + 1)
+                    if len(out) == count:
+                        break
+        return out
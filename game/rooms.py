@@ -0,0 +1,386 @@
+import asyncio
+import logging
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import movelog
+from .db import writes
+from .engine import Board, touched_cells
+from .metrics import metrics
+from .models import GameBoard, MoveLog
+from .protocol import encode, move_payload, pack_board, tick_payload
+from .rng import GemRNG
+
+DEFAULT_ROOM = 'game_room'
+DEFAULT_BOARD_ID = uuid.UUID('f47ac10b-58cc-4372-a567-0e02b2c3d479')
+
+logger = logging.getLogger(__name__)
+
+# Seconds between write-behind flushes of dirty rooms
+FLUSH_INTERVAL = 2.0
+
+# Seconds an emptied room stays in memory, so players reconnecting get
+# their snapshot without a database read
+ROOM_IDLE_TIMEOUT = 30.0
+
+# Most broadcast messages a room sends per second; moves made in between
+# go out together in the next one
+BROADCAST_RATE = 20
+
+# How far behind each connection in this process is, by channel name: the
+# versions between the room's latest broadcast and the one it acknowledged
+client_lag = {}
+
+# Boards rooms are played on, as (width, height, gem kinds). A room named
+# "<preset>-<id>" starts with that preset's board and any other room with
+# DEFAULT_PRESET's; a stored board keeps the shape it was created with.
+# The binary protocol sends coordinates as single bytes.
+BOARD_PRESETS = {
+    'classic': (8, 8, 7),
+    'small': (6, 6, 5),
+    'big': (16, 16, 7),
+    'mega': (32, 32, 7),
+}
+DEFAULT_PRESET = 'classic'
+
+
+def board_id_for(name):
+    """Returns the GameBoard id backing a room; the default room keeps its original board."""
+    if name == DEFAULT_ROOM:
+        return DEFAULT_BOARD_ID
+    return uuid.uuid5(DEFAULT_BOARD_ID, name)
+
+
+def board_shape(name):
+    """Returns the (width, height, gem kinds) a room's board is created with."""
+    preset, sep, _ = name.partition('-')
+    return BOARD_PRESETS[preset if sep and preset in BOARD_PRESETS else DEFAULT_PRESET]
+
+
+def new_room_name(preset=None):
+    name = uuid.uuid4().hex[:8]
+    if preset in BOARD_PRESETS and preset != DEFAULT_PRESET:
+        return f'{preset}-{name}'
+    return name
+
+
+def group_name(name):
+    return f'game_{name}'
+
+
+class Room:
+    """Authoritative in-process state for one room while anyone is connected.
+
+    Moves are applied by a single worker per room, in the order they were
+    submitted, so each one sees the board the previous one left behind.
+    Each is appended to ``log``, the move log records not yet flushed, which
+    pick up from ``log_start``. Refills and reshuffles draw from the room's
+    own ``rng``, so the game can be replayed from its state.
+    """
+
+    def __init__(self, name, board_id, board, version, rng=None):
+        self.name = name
+        self.board_id = board_id
+        self.board = board
+        self.version = version
+        self.rng = rng if rng is not None else GemRNG()
+        self.log = bytearray(movelog.encode_board(board) + movelog.encode_rng(self.rng))
+        self.log_start = version
+        self.clients = 0
+        # Clients by the protocol they speak, for those that said
+        self.protocols = {}
+        self.dirty = False
+        self.outbox = []
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self._ticker = None
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def check_move(self, x1, y1, x2, y2, version=None):
+        """Returns why a swap would be rejected right now, or None if it is legal.
+
+        ``version`` is the board version the client saw; a move made against
+        any other version is stale. Once the board's legal moves are known this
+        is a set lookup, so illegal moves cost nothing more.
+        """
+        if version is not None and version != self.version:
+            return 'stale'
+        board = self.board
+        if not (board.in_bounds(x1, y1) and board.in_bounds(x2, y2)):
+            return 'illegal'
+        a, b = board.index(x1, y1), board.index(x2, y2)
+        if (min(a, b), max(a, b)) not in board.legal_moves():
+            return 'illegal'
+        return None
+
+    def apply_swap(self, x1, y1, x2, y2):
+        """Applies a swap and its cascade to the board.
+
+        Returns a move dict with the swap, cascade steps, whether the board was
+        reshuffled and the [index, gem, ...] diff, or None if the swap is not
+        one of the board's legal moves.
+        """
+        if self.check_move(x1, y1, x2, y2) is not None:
+            metrics.inc('moves_total', result='illegal')
+            return None
+        board = self.board
+        before = board.copy()
+        board.swap(x1, y1, x2, y2)
+        swapped = (board.index(x1, y1), board.index(x2, y2))
+        with metrics.timer('match_search'):
+            matches = board.find_matches_around(swapped)
+
+        board.invalidate_hint(swapped)
+        with metrics.timer('gravity'):
+            steps = board.cascade(matches, self.rng)
+        with metrics.timer('move_search'):
+            shuffled = not board.has_valid_moves()
+        self.log += movelog.encode_move(swapped[0], swapped[1], movelog.move_draws(steps))
+        if shuffled:
+            self.reshuffle()
+        metrics.inc('moves_total', result='applied')
+        metrics.inc('cascade_levels_total', len(steps))
+        self.version += 1
+        self.mark_dirty()
+        return {
+            'swap': [x1, y1, x2, y2],
+            'steps': steps,
+            'shuffled': shuffled,
+            'diff': self.board.diff(before) if shuffled else board.diff(before, touched_cells(swapped, steps)),
+        }
+
+    def reshuffle(self):
+        """Replaces the board with a new one from the room's RNG, logged as a reshuffle."""
+        board = self.board
+        self.board = Board.generate(board.width, board.height, self.rng, kinds=board.kinds)
+        self.log += movelog.encode_board(self.board)
+        metrics.inc('shuffles_total')
+        self.mark_dirty()
+
+    def publish(self, player_id, move, frames):
+        """Queues a move and its encoded frames for the room's next broadcast."""
+        self.outbox.append({'player_id': player_id, 'version': self.version, 'diff': move['diff'], 'frames': frames})
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.ensure_future(self._tick())
+
+    def tick_frames(self, moves):
+        """Encodes one frame per protocol covering all of a tick's moves.
+
+        A lone move keeps its own frame, cascade and all; several are merged
+        into the changes from the version before the first of them to now.
+        """
+        if len(moves) == 1:
+            return moves[0]['frames']
+        changed = set()
+        for move in moves:
+            changed.update(move['diff'][::2])
+        cells = self.board.cells
+        diff = [x for i in sorted(changed) for x in (i, cells[i])]
+        base = moves[0]['version'] - 1
+        return {p: encode(p, tick_payload(p, self, base, diff)) for p in self.protocols}
+
+    async def _tick(self):
+        # The first move goes out at once; later ones are batched so the room
+        # sends at most BROADCAST_RATE messages a second, each one frame per
+        # protocol however many moves it carries. Exits when idle.
+        while self.outbox:
+            moves, self.outbox = self.outbox, []
+            metrics.inc('broadcasts_total')
+            try:
+                with metrics.timer('serialize'):
+                    frames = self.tick_frames(moves)
+                with metrics.timer('broadcast'):
+                    await get_channel_layer().group_send(group_name(self.name), {
+                        'type': 'broadcast_moves',
+                        'version': self.version,
+                        'players': sorted({move['player_id'] for move in moves}),
+                        'frames': frames,
+                    })
+            except Exception:
+                logger.exception("Failed to broadcast room %s", self.name)
+            await asyncio.sleep(1 / BROADCAST_RATE)
+
+    async def submit(self, handler, *args):
+        """Queues ``await handler(*args)`` on the room's worker and returns its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((handler, args, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        return await future
+
+    async def _run(self):
+        # Exits when the queue drains; the next submit starts a new worker
+        while not self._queue.empty():
+            handler, args, future = self._queue.get_nowait()
+            if future.cancelled():
+                continue
+            try:
+                result = await handler(*args)
+            except Exception as exc:
+                if not future.cancelled():
+                    future.set_exception(exc)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+
+async def play_move(room, x1, y1, x2, y2, player_id, protocol, version=None):
+    """Applies a move and queues its broadcast to the room; run it on the room's worker.
+
+    Returns the mover's message and the number of gems cleared at each cascade
+    level, or the reason the move was rejected ('stale' or 'illegal').
+    """
+    reason = room.check_move(x1, y1, x2, y2, version)
+    if reason is not None:
+        metrics.inc('moves_total', result=reason)
+        return reason
+    move = room.apply_swap(x1, y1, x2, y2)
+    # The whole cascade goes out as one script; clients animate it. Frames are
+    # encoded once for each protocol the room's clients speak and spectators
+    # just forward them, so a room with no json clients never builds the
+    # full-board json message.
+    with metrics.timer('serialize'):
+        payloads = {p: move_payload(p, room, move, player_id) for p in {protocol, *room.protocols}}
+        frames = {p: encode(p, payloads[p]) for p in room.protocols}
+    room.publish(player_id, move, frames)
+    return payloads[protocol], [len(step.cleared) for step in move['steps']]
+
+
+class RoomStore:
+    """Keeps live rooms in memory and writes them back to GameBoard behind play.
+
+    Rooms are loaded on first join, flushed every FLUSH_INTERVAL seconds while
+    dirty, flushed when the last client leaves, and dropped if nobody has
+    rejoined within ``idle_timeout`` seconds.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, idle_timeout=ROOM_IDLE_TIMEOUT):
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.rooms = {}
+        self._loading = {}
+        self._flusher = None
+
+    async def join(self, name, protocol=None):
+        room = self.rooms.get(name)
+        if room is None:
+            # Concurrent joins of a cold room share one load
+            if name not in self._loading:
+                self._loading[name] = asyncio.ensure_future(self._load(name))
+            try:
+                room = await asyncio.shield(self._loading[name])
+            finally:
+                self._loading.pop(name, None)
+            room = self.rooms.setdefault(name, room)
+        room.clients += 1
+        if protocol is not None:
+            room.protocols[protocol] = room.protocols.get(protocol, 0) + 1
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+        return room
+
+    async def leave(self, room, protocol=None):
+        room.clients -= 1
+        if protocol is not None:
+            count = room.protocols.get(protocol, 0) - 1
+            if count > 0:
+                room.protocols[protocol] = count
+            else:
+                room.protocols.pop(protocol, None)
+        if room.clients <= 0:
+            await self.flush(room)
+            if room.clients <= 0:
+                asyncio.ensure_future(self._evict_later(room))
+
+    async def _evict_later(self, room):
+        await asyncio.sleep(self.idle_timeout)
+        if room.clients <= 0 and self.rooms.get(room.name) is room:
+            await self.flush(room)
+            if room.clients <= 0 and self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+
+    async def flush(self, room):
+        if not room.dirty:
+            return
+        room.dirty = False
+        log, start = room.log, room.log_start
+        room.log, room.log_start = bytearray(), room.version
+        try:
+            with metrics.timer('db_flush'):
+                await self._save(
+                    room.board_id, pack_board(room.board), room.version, room.rng.getstate(), bytes(log), start
+                )
+        except Exception:
+            room.dirty = True
+            room.log[:0] = log
+            room.log_start = start
+            raise
+
+    async def flush_all(self):
+        for room in list(self.rooms.values()):
+            await self.flush(room)
+
+    async def _flush_loop(self):
+        while self.rooms:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_all()
+            except Exception:
+                # Rooms stay dirty and are retried on the next tick
+                logger.exception("Failed to flush rooms")
+
+    async def _load(self, name):
+        board_id = board_id_for(name)
+        with metrics.timer('db_load'):
+            board, version, rng = await self._load_board(board_id, board_shape(name))
+        room = Room(name, board_id, board, version, rng)
+        if board.find_matches() or not board.has_valid_moves():
+            # Boards stored before they were generated playable can hold runs
+            # or have no moves, and a board is otherwise only reshuffled
+            # after a move, which such a board may never allow
+            room.reshuffle()
+        return room
+
+    @database_sync_to_async
+    def _load_board(self, board_id, shape):
+        game_board = GameBoard.objects.filter(id=board_id).first()
+        if game_board is None:
+            # A new room: its board is generated here, in the room's shape, and
+            # inserted once, rather than GameBoard.save() generating one too
+            rng = GemRNG()
+            width, height, kinds = shape
+            board = Board.generate(width, height, rng, kinds=kinds)
+            try:
+                with transaction.atomic():
+                    GameBoard.objects.create(id=board_id, board_data=pack_board(board), rng_state=rng.getstate())
+                return board, 0, rng
+            except IntegrityError:
+                # Another process created it first; play its board
+                game_board = GameBoard.objects.get(id=board_id)
+        # Boards saved before rooms had their own RNG get a freshly seeded one
+        rng = GemRNG.from_state(bytes(game_board.rng_state)) if game_board.rng_state else GemRNG()
+        board = game_board.board
+        if board is None:
+            width, height, kinds = shape
+            board = Board.generate(width, height, rng, kinds=kinds)
+            GameBoard.objects.filter(id=board_id).update(board_data=pack_board(board), rng_state=rng.getstate())
+        return board, game_board.version, rng
+
+    @writes
+    def _save(self, board_id, board_data, version, rng_state, log, log_start):
+        # The board, its RNG and the log of the moves that led to them land together
+        with transaction.atomic():
+            GameBoard.objects.filter(id=board_id).update(
+                board_data=board_data, version=version, rng_state=rng_state, last_updated=timezone.now()
+            )
+            if log:
+                MoveLog.objects.create(board_id=board_id, start_version=log_start, end_version=version, data=log)
+
+
+rooms = RoomStore()
@@ -1,7 +1,11 @@
-from django.urls import re_path
+from django.urls import path, re_path
 from game.consumers import GameConsumer
 
+# Room names in URLs: slugs of at most 64 characters, so a room's group
+# name stays inside the channel layer's 100-character limit
+ROOM_ID = r'(?P<room_id>[-a-zA-Z0-9_]{1,64})'
+
 websocket_urlpatterns = [
-    re_path(r'ws/game/', GameConsumer.as_asgi()),  # WebSocket URL for the game
+    path('ws/game/', GameConsumer.as_asgi()),  # The shared default room
+    re_path(rf'^ws/game/{ROOM_ID}/$', GameConsumer.as_asgi()),
 ]
-
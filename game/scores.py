@@ -0,0 +1,132 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+
+from .db import writes
+from .leaderboard import leaderboard
+from .metrics import metrics
+from .models import GamePlayer
+
+logger = logging.getLogger(__name__)
+
+# Seconds points are held so rapid moves share one write
+SCORE_FLUSH_DELAY = 0.5
+
+
+def points_for(cleared, combo_multiplier):
+    """Points for clearing ``cleared`` gems at the given combo multiplier."""
+    points_per_gem = 10
+    size_multiplier = 1.0
+    if cleared > 3:
+        size_multiplier = 1.5
+    if cleared > 4:
+        size_multiplier = 2.0
+    return int(cleared * points_per_gem * size_multiplier * combo_multiplier)
+
+
+def cascade_points(cleared):
+    """Points for a cascade given the gems cleared at each level.
+
+    Each level after the first raises the combo multiplier by 0.5. Returns the
+    points and the final multiplier.
+    """
+    combo_multiplier = 1.0
+    points = 0
+    for level, count in enumerate(cleared):
+        if level:
+            combo_multiplier += 0.5
+        points += points_for(count, combo_multiplier)
+    return points, combo_multiplier
+
+
+class ScoreBuffer:
+    """Accumulates points per user in memory and commits them as F() increments.
+
+    Every tab of a user in this process shares one running total. Pending
+    points are written SCORE_FLUSH_DELAY seconds after the first unflushed
+    move, so a burst of moves costs one UPDATE per user.
+    """
+
+    def __init__(self, flush_delay=SCORE_FLUSH_DELAY):
+        self.flush_delay = flush_delay
+        self.totals = {}
+        self.pending = {}
+        self.sessions = {}
+        self._flusher = None
+
+    def track(self, user_id, score):
+        """Starts tracking a user from their stored score; returns the live total."""
+        self.sessions[user_id] = self.sessions.get(user_id, 0) + 1
+        return self.totals.setdefault(user_id, score)
+
+    async def join(self, user_id):
+        """Starts tracking a user and returns their live total.
+
+        The score comes from this process's running totals or the leaderboard
+        when either knows the player, so only a player neither has seen costs
+        a read, which creates their GamePlayer if needed.
+        """
+        score = self.totals.get(user_id)
+        if score is None and leaderboard.loaded:
+            score = leaderboard.scores.get(user_id)
+        if score is None:
+            score = await self._load(user_id)
+        return self.track(user_id, score)
+
+    async def release(self, user_id):
+        """Flushes pending points and forgets the user once their last tab closes."""
+        await self.flush()
+        sessions = self.sessions.get(user_id, 0) - 1
+        if sessions > 0:
+            self.sessions[user_id] = sessions
+        else:
+            self.sessions.pop(user_id, None)
+            if user_id not in self.pending:
+                self.totals.pop(user_id, None)
+
+    def add(self, user_id, points):
+        """Adds points for a user and returns their new total."""
+        total = self.totals.get(user_id, 0) + points
+        self.totals[user_id] = total
+        if points:
+            self.pending[user_id] = self.pending.get(user_id, 0) + points
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.ensure_future(self._flush_later())
+        return total
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            with metrics.timer('score_commit'):
+                await self._commit(batch)
+        except Exception:
+            # Put the points back so the next flush retries them
+            for user_id, points in batch.items():
+                self.pending[user_id] = self.pending.get(user_id, 0) + points
+            raise
+        await leaderboard.record(batch)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Failed to flush scores")
+
+    @database_sync_to_async
+    def _load(self, user_id):
+        player, _ = GamePlayer.objects.get_or_create(user_id=user_id)
+        return player.score
+
+    @writes
+    def _commit(self, batch):
+        with transaction.atomic():
+            for user_id, points in batch.items():
+                GamePlayer.add_score(user_id, points)
+
+
+scores = ScoreBuffer()
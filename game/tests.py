@@ -1,3 +1,727 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from channels.auth import UserLazyObject
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from game import auth, consumers, movelog, reference
+from game.db import DBWriter
+from game.engine import EMPTY, MAX_GEM_KINDS, MIN_GEM_KINDS, Board
+from game.layers import Broker, BrokerChannelLayer
+from game.leaderboard import PUSH_SIZE, Leaderboard
+from game.management.commands.simulate import replay_mismatch
+from game.models import GameBoard, GamePlayer, MoveLog
+from game.protocol import (
+    COLOR_NAMES, board_payload, decode_binary, decode_client_binary, encode, encode_client_ack,
+    encode_client_move, move_payload, pack_board, pack_cells, tick_payload, unpack_board, unpack_cells,
+)
+from game.rng import GemRNG
+from game.rooms import Room, RoomStore, board_id_for, play_move, rooms
+from game.routing import websocket_urlpatterns
+from game.scores import ScoreBuffer
+
+SHAPES = [(8, 8), (3, 3), (3, 12), (12, 3), (5, 7), (16, 16)]
+
+
+def play_room(board, rng, moves):
+    """Plays a room's hints, as bench_boards does; returns the room."""
+    room = Room('test', uuid.uuid4(), board, 0, rng)
+    width = board.width
+    for _ in range(moves):
+        a, b = room.board.hint()
+        room.apply_swap(a % width, a // width, b % width, b // width)
+    return room
+
+
+def reference_moves(rows):
+    """Every matching swap, found by the reference's rescan of the whole board."""
+    height, width = len(rows), len(rows[0])
+    moves = set()
+    for y in range(height):
+        for x in range(width):
+            for x2, y2 in ((x + 1, y), (x, y + 1)):
+                if x2 < width and y2 < height:
+                    reference.swap_gems(rows, x, y, x2, y2)
+                    if reference.find_matches(rows):
+                        moves.add((y * width + x, y2 * width + x2))
+                    reference.swap_gems(rows, x, y, x2, y2)
+    return moves
+
+
+def final_board(segments):
+    for version, board in movelog.replay(segments):
+        pass
+    return version, board
+
+
+class GenerateTests(SimpleTestCase):
+    def test_every_seed_and_shape_gives_a_playable_board(self):
+        for kinds in (MIN_GEM_KINDS, MAX_GEM_KINDS):
+            for width, height in SHAPES:
+                for seed in range(300):
+                    with self.subTest(width=width, height=height, kinds=kinds, seed=seed):
+                        board = Board.generate(width, height, GemRNG(seed), kinds=kinds)
+                        self.assertNotIn(EMPTY, board.cells)
+                        self.assertLessEqual(max(board.cells), kinds)
+                        self.assertEqual(board.find_matches(), set())
+                        self.assertTrue(board.legal_moves())
+
+    def test_seeds_that_once_ran_out_of_gems(self):
+        # These left a cell with no allowed gem when three kinds were allowed
+        for seed in (166, 296):
+            board = Board.generate(8, 8, seed=seed, kinds=MIN_GEM_KINDS)
+            self.assertTrue(board.legal_moves())
+
+
+class EngineTests(SimpleTestCase):
+    def test_matches_agree_with_the_reference(self):
+        rng = random.Random(0)
+        for width, height in SHAPES:
+            for _ in range(50):
+                board = Board(width, height, bytes(rng.randint(1, 4) for _ in range(width * height)), 4)
+                with self.subTest(width=width, height=height, cells=list(board.cells)):
+                    expected = reference.find_matches(board.to_colors())
+                    self.assertEqual({divmod(i, width) for i in board.find_matches()}, expected)
+
+    def test_matches_around_a_swap_are_the_whole_board_matches(self):
+        board = Board.generate(8, 8, GemRNG(0))
+        cells = board.cells
+        for a in range(64):
+            for b in (a + 1, a + 8):
+                if b >= 64 or (b == a + 1 and b % 8 == 0):
+                    continue
+                cells[a], cells[b] = cells[b], cells[a]
+                with self.subTest(a=a, b=b):
+                    self.assertEqual(board.find_matches_around((a, b)), board.find_matches())
+                cells[a], cells[b] = cells[b], cells[a]
+
+    def test_legal_moves_agree_with_the_reference(self):
+        for width, height in SHAPES:
+            for seed in range(20):
+                board = Board.generate(width, height, GemRNG(seed))
+                with self.subTest(width=width, height=height, seed=seed):
+                    self.assertEqual(board.legal_moves(), reference_moves(board.to_colors()))
+
+    def test_cascades_agree_with_the_reference(self):
+        for width, height in ((8, 8), (16, 16)):
+            rng = GemRNG(3)
+            room = Room('test', uuid.uuid4(), Board.generate(width, height, rng), 0, rng)
+            for n in range(200):
+                a, b = min(room.board.legal_moves())
+                rows = room.board.to_colors()
+                move = room.apply_swap(a % width, a // width, b % width, b // width)
+                after = None if move['shuffled'] else room.board
+                with self.subTest(width=width, move=n):
+                    self.assertIsNone(replay_mismatch(rows, width, a, b, move['steps'], after))
+
+    def test_move_set_kept_up_to_date_as_moves_are_played(self):
+        # Rooms check every move against legal_moves(), so each cascade
+        # updates the set in place rather than rebuilding it
+        for width, height in ((8, 8), (16, 16), (32, 32)):
+            room = play_room(Board.generate(width, height, GemRNG(4)), GemRNG(4), 0)
+            for n in range(200):
+                board = room.board
+                with self.subTest(width=width, move=n):
+                    self.assertEqual(board.legal_moves(), Board(width, height, board.cells).legal_moves())
+                    if width == 8:
+                        self.assertEqual(board.legal_moves(), reference_moves(board.to_colors()))
+                    self.assertIn(board.hint(), board.legal_moves())
+                a, b = board.hint()
+                room.apply_swap(a % width, a // width, b % width, b // width)
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_cells_pack_and_unpack(self):
+        rng = random.Random(0)
+        for count in range(70):
+            cells = [rng.randrange(8) for _ in range(count)]
+            packed = pack_cells(cells)
+            with self.subTest(count=count):
+                self.assertEqual(len(packed), (count * 3 + 7) // 8)
+                self.assertEqual(unpack_cells(packed, count), cells)
+
+    def test_boards_pack_and_unpack_in_every_format(self):
+        boards = [
+            Board.generate(8, 8, GemRNG(0)),
+            Board.generate(6, 6, GemRNG(0), kinds=5),
+            Board(3, 3, bytes([8, 1, 2, 3, 9, 1, 2, 3, 1])),
+        ]
+        for board in boards:
+            with self.subTest(kinds=board.kinds, cells=list(board.cells)):
+                unpacked = unpack_board(pack_board(board))
+                self.assertEqual((unpacked.width, unpacked.height), (board.width, board.height))
+                self.assertEqual(unpacked.cells, board.cells)
+                self.assertEqual(unpacked.kinds, board.kinds)
+
+    def test_binary_frames_decode_to_the_delta_payload(self):
+        room = play_room(Board.generate(8, 8, GemRNG(5)), GemRNG(5), 0)
+        for n in range(60):
+            a, b = room.board.hint()
+            move = room.apply_swap(a % 8, a // 8, b % 8, b // 8)
+            payload = move_payload('binary', room, move, 'player')
+            payload.update({'score': 1234, 'combo_multiplier': 1.5, 'seq': n})
+            expected = json.loads(json.dumps(payload))
+            del expected['player_id']
+            with self.subTest(version=room.version):
+                self.assertEqual(decode_binary(encode('binary', payload)), expected)
+                self.assertEqual(decode_binary(encode('binary', payload, mine=True)), dict(expected, mine=True))
+        snapshot = board_payload('binary', room)
+        self.assertEqual(decode_binary(encode('binary', snapshot)), snapshot)
+        tick = tick_payload('binary', room, room.version - 2, [0, 3, 9, 1])
+        self.assertEqual(decode_binary(encode('binary', tick)), tick)
+
+    def test_client_frames_round_trip(self):
+        self.assertEqual(
+            decode_client_binary(encode_client_move(1, 2, 1, 3, 7)),
+            {'x1': 1, 'y1': 2, 'x2': 1, 'y2': 3, 'seq': 7},
+        )
+        self.assertEqual(
+            decode_client_binary(encode_client_move(1, 2, 1, 3, 7, 99)),
+            {'x1': 1, 'y1': 2, 'x2': 1, 'y2': 3, 'seq': 7, 'v': 99},
+        )
+        self.assertEqual(decode_client_binary(encode_client_ack(99)), {'type': 'ack', 'v': 99})
+
+    def test_malformed_client_frames_raise_value_error(self):
+        for data in (b'', b'\x01\x02', encode_client_move(1, 2, 1, 3, 7) + b'\0', encode_client_ack(7)[:3], b'\x09'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    decode_client_binary(data)
+
+    def test_json_boards_carry_color_names(self):
+        room = play_room(Board.generate(8, 8, GemRNG(6)), GemRNG(6), 1)
+        rows = board_payload('json', room)['board']
+        self.assertEqual(Board.from_colors(rows).cells, room.board.cells)
+        self.assertEqual(COLOR_NAMES.index(rows[0][0]), room.board.cells[0])
+
+
+class ReplayTests(SimpleTestCase):
+    def test_replay_reaches_the_room_board(self):
+        room = play_room(Board.generate(8, 8, GemRNG(1)), GemRNG(1), 300)
+        version, board = final_board([bytes(room.log)])
+        self.assertEqual(version, room.version)
+        self.assertEqual(board.cells, room.board.cells)
+
+    def test_replay_without_an_rng_record_uses_the_recorded_gems(self):
+        rng = GemRNG(2)
+        board = Board.generate(8, 8, rng)
+        start = len(movelog.encode_board(board))
+        end = start + len(movelog.encode_rng(rng))
+        room = play_room(board, rng, 300)
+        self.assertEqual(room.log[start], movelog.RECORD_RNG)
+        version, board = final_board([bytes(room.log[:start] + room.log[end:])])
+        self.assertEqual(version, room.version)
+        self.assertEqual(board.cells, room.board.cells)
+
+    def test_replay_across_segments(self):
+        # A room that resumes starts its next segment with its board and RNG
+        room = play_room(Board.generate(6, 6, GemRNG(7), kinds=5), GemRNG(7), 100)
+        first = bytes(room.log)
+        room.log = bytearray(movelog.encode_board(room.board) + movelog.encode_rng(room.rng))
+        width = room.board.width
+        for _ in range(100):
+            a, b = room.board.hint()
+            room.apply_swap(a % width, a // width, b % width, b // width)
+        version, board = final_board([first, bytes(room.log)])
+        self.assertEqual(version, 200)
+        self.assertEqual(board.cells, room.board.cells)
+        self.assertEqual(board.kinds, 5)
+
+    def test_replay_segments_flushed_after_every_move(self):
+        # Later segments start with their first move, or with a reshuffle
+        rng = GemRNG(11)
+        room = Room('test', uuid.uuid4(), Board.generate(5, 5, rng, kinds=5), 0, rng)
+        segments = []
+        shuffles = 0
+        for _ in range(300):
+            a, b = room.board.hint()
+            shuffles += room.apply_swap(a % 5, a // 5, b % 5, b // 5)['shuffled']
+            segments.append(bytes(room.log))
+            room.log = bytearray()
+        self.assertGreater(shuffles, 0)
+        version, board = final_board(segments)
+        self.assertEqual(version, 300)
+        self.assertEqual(board.cells, room.board.cells)
+
+    def test_replay_rejects_an_illegal_move(self):
+        board = Board.generate(8, 8, GemRNG(8))
+        a, b = next((i, i + 1) for i in range(63) if (i + 1) % 8 and (i, i + 1) not in board.legal_moves())
+        with self.assertRaises(movelog.LogError):
+            final_board([movelog.encode_board(board) + movelog.encode_move(a, b, [])])
+
+    def test_replay_rejects_refills_the_rng_did_not_draw(self):
+        room = play_room(Board.generate(8, 8, GemRNG(9)), GemRNG(9), 20)
+        log = b''
+        for record in movelog.read_records(bytes(room.log)):
+            if record[0] == 'move':
+                _, a, b, draws = record
+                log += movelog.encode_move(a, b, [gem % MAX_GEM_KINDS + 1 for gem in draws])
+            elif record[0] == 'board':
+                log += movelog.encode_board(record[1])
+            else:
+                log += movelog.encode_rng(GemRNG.from_state(record[1]))
+        with self.assertRaises(movelog.LogError):
+            final_board([log])
+
+
+@override_settings(GAME_DB_WRITER=False)
+class RoomStoreTests(TransactionTestCase):
+    async def load_stored(self, name, board):
+        await GameBoard.objects.acreate(id=board_id_for(name), board_data=pack_board(board), rng_state=GemRNG(1).getstate())
+        store = RoomStore()
+        room = await store.join(name)
+        room.clients -= 1
+        return store, room
+
+    async def test_unplayable_stored_boards_are_reshuffled_on_load(self):
+        stuck = Board(8, 8, bytes((x + y) % 7 + 1 for y in range(8) for x in range(8)))
+        runs = Board(8, 8, bytes(1 if y == 0 else (x + y) % 7 + 1 for y in range(8) for x in range(8)))
+        for name, board in (('stuck', stuck), ('runs', runs)):
+            with self.subTest(name=name):
+                store, room = await self.load_stored(name, board)
+                self.assertEqual(room.board.find_matches(), set())
+                self.assertTrue(room.board.has_valid_moves())
+                self.assertTrue(room.dirty)
+                await store.flush(room)
+                stored = await GameBoard.objects.aget(id=room.board_id)
+                self.assertEqual(stored.board.cells, room.board.cells)
+                segments = [bytes(log.data) async for log in MoveLog.objects.filter(board_id=room.board_id)]
+                self.assertEqual(final_board(segments)[1].cells, room.board.cells)
+
+    async def test_playable_stored_boards_are_kept(self):
+        board = Board.generate(8, 8, GemRNG(10))
+        _, room = await self.load_stored('kept', board)
+        self.assertEqual(room.board.cells, board.cells)
+        self.assertFalse(room.dirty)
+
+
+@override_settings(GAME_DB_WRITER=False)
+class ScoreBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='scorer')
+        GamePlayer.objects.create(user=self.user)
+
+    async def stored_score(self):
+        return (await GamePlayer.objects.aget(user=self.user)).score
+
+    async def test_flush_commits_pending_points(self):
+        buffer = ScoreBuffer()
+        self.assertEqual(await buffer.join(self.user.id), 0)
+        buffer.add(self.user.id, 30)
+        self.assertEqual(buffer.add(self.user.id, 20), 50)
+        await buffer.flush()
+        self.assertEqual(buffer.pending, {})
+        self.assertEqual(await self.stored_score(), 50)
+
+    async def test_failed_flush_keeps_the_points_for_the_next(self):
+        buffer = ScoreBuffer()
+        await buffer.join(self.user.id)
+        buffer.add(self.user.id, 30)
+        with mock.patch.object(GamePlayer, 'add_score', side_effect=RuntimeError("database is locked")):
+            with self.assertRaises(RuntimeError):
+                await buffer.flush()
+        self.assertEqual(buffer.pending, {self.user.id: 30})
+        self.assertEqual(await self.stored_score(), 0)
+        buffer.add(self.user.id, 5)
+        await buffer.flush()
+        self.assertEqual(buffer.pending, {})
+        self.assertEqual(await self.stored_score(), 35)
+
+
+
+class BrokerTests(SimpleTestCase):
+    @contextlib.asynccontextmanager
+    async def running(self, **kwargs):
+        # A broker on a socket of its own, and the layers each test opens on it
+        self.broker = Broker(**kwargs)
+        self.layers = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'broker.sock')
+            server = asyncio.ensure_future(self.broker.serve(path))
+            try:
+                while not os.path.exists(path):
+                    await asyncio.sleep(0.01)
+                yield path
+            finally:
+                for layer in self.layers:
+                    await layer.close()
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+
+    def layer(self, path, **kwargs):
+        layer = BrokerChannelLayer(path, **kwargs)
+        self.layers.append(layer)
+        return layer
+
+    async def until(self, condition):
+        async with asyncio.timeout(2):
+            while not condition():
+                await asyncio.sleep(0.01)
+
+    async def test_send_and_receive(self):
+        async with self.running() as path:
+            sender, receiver = self.layer(path), self.layer(path)
+            channel = await receiver.new_channel()
+            # Queued before the receive, then answered while it waits
+            await sender.send(channel, {'type': 'first', 'frame': b'\x00\x01'})
+            self.assertEqual(await receiver.receive(channel), {'type': 'first', 'frame': b'\x00\x01'})
+            waiting = asyncio.ensure_future(receiver.receive(channel))
+            await self.until(lambda: channel in self.broker.waiters)
+            await sender.send(channel, {'type': 'second'})
+            self.assertEqual(await waiting, {'type': 'second'})
+            self.assertEqual(self.broker.queues, {})
+            self.assertEqual(self.broker.waiters, {})
+
+    async def test_group_send_reaches_every_member(self):
+        async with self.running() as path:
+            first, second = self.layer(path), self.layer(path)
+            one, two = await first.new_channel(), await second.new_channel()
+            await first.group_add('room', one)
+            await second.group_add('room', two)
+            await first.group_send('room', {'type': 'update'})
+            self.assertEqual(await first.receive(one), {'type': 'update'})
+            self.assertEqual(await second.receive(two), {'type': 'update'})
+            await second.group_discard('room', two)
+            await first.group_send('room', {'type': 'later'})
+            self.assertEqual(await first.receive(one), {'type': 'later'})
+            self.assertNotIn(two, self.broker.queues)
+
+    async def test_a_cancelled_receive_leaves_no_waiter(self):
+        async with self.running() as path:
+            layer = self.layer(path)
+            channel = await layer.new_channel()
+            waiting = asyncio.ensure_future(layer.receive(channel))
+            await self.until(lambda: channel in self.broker.waiters)
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            await self.until(lambda: channel not in self.broker.waiters)
+            # The message goes to the next receive rather than the cancelled one
+            await layer.send(channel, {'type': 'after'})
+            self.assertEqual(await layer.receive(channel), {'type': 'after'})
+
+    async def test_a_closed_connection_leaves_no_waiters_or_memberships(self):
+        async with self.running() as path:
+            layer = self.layer(path)
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            waiting = asyncio.ensure_future(layer.receive(channel))
+            await self.until(lambda: channel in self.broker.waiters)
+            await layer.close()
+            await asyncio.gather(waiting, return_exceptions=True)
+            await self.until(lambda: not self.broker.waiters and not self.broker.groups)
+
+    async def test_expired_messages_are_never_received(self):
+        async with self.running() as path:
+            layer = self.layer(path, expiry=0.05)
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            await layer.send(channel, {'type': 'stale'})
+            await self.until(lambda: channel in self.broker.queues)
+            await asyncio.sleep(0.1)
+            # An expired message is dropped on receive, and on the next delivery
+            with self.assertRaises(TimeoutError):
+                async with asyncio.timeout(0.1):
+                    await layer.receive(channel)
+            await layer.send(channel, {'type': 'stale'})
+            await self.until(lambda: channel in self.broker.queues)
+            await asyncio.sleep(0.1)
+            await layer.send(channel, {'type': 'fresh'})
+            await self.until(lambda: len(self.broker.queues.get(channel, ())) == 1)
+            self.assertEqual(await layer.receive(channel), {'type': 'fresh'})
+
+    async def test_sweep_drops_channels_nobody_reads(self):
+        async with self.running() as path:
+            layer = self.layer(path, expiry=0.05)
+            read, unread = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('room', read)
+            await layer.group_add('room', unread)
+            await layer.send(unread, {'type': 'ignored'})
+            await self.until(lambda: unread in self.broker.queues)
+            await asyncio.sleep(0.1)
+            self.broker.sweep()
+            self.assertEqual(self.broker.queues, {})
+            self.assertEqual(self.broker.groups, {'room': {read}})
+
+
+class LeaderboardTests(SimpleTestCase):
+    def board(self, scores):
+        board = Leaderboard()
+        for user_id, score in scores.items():
+            board.set(user_id, score, f'player{user_id}')
+        board.loaded = True
+        return board
+
+    def test_tied_players_share_the_best_rank(self):
+        board = self.board({1: 50, 2: 80, 3: 50, 4: 10})
+        self.assertEqual(board.rank(2), (1, 80))
+        self.assertEqual(board.rank(1), (2, 50))
+        self.assertEqual(board.rank(3), (2, 50))
+        self.assertEqual(board.rank(4), (4, 10))
+        # Players without points yet rank as scoring 0
+        self.assertEqual(board.rank(99), (5, 0))
+
+    def test_top_gives_ties_one_rank_and_skips_past_them(self):
+        board = self.board({1: 50, 2: 80, 3: 50, 4: 10})
+        self.assertEqual(board.top(4), [
+            {'rank': 1, 'username': 'player2', 'score': 80},
+            {'rank': 2, 'username': 'player1', 'score': 50},
+            {'rank': 2, 'username': 'player3', 'score': 50},
+            {'rank': 4, 'username': 'player4', 'score': 10},
+        ])
+        self.assertEqual([entry['username'] for entry in board.top(2)], ['player2', 'player1'])
+
+    def test_set_moves_a_player_to_their_new_place(self):
+        board = self.board({1: 50, 2: 80, 3: 30})
+        board.set(3, 90)
+        self.assertEqual(board.order, [(-90, 3), (-80, 2), (-50, 1)])
+        board.set(3, 20)
+        self.assertEqual(board.order, [(-80, 2), (-50, 1), (-20, 3)])
+        self.assertEqual(board.rank(3), (3, 20))
+
+    async def test_record_waits_for_the_load(self):
+        board = Leaderboard()
+        with mock.patch.object(board, 'changed') as changed:
+            await board.record({1: 30})
+        self.assertEqual(board.scores, {})
+        changed.assert_not_called()
+
+    async def test_record_adds_points_and_pushes_when_the_top_changes(self):
+        board = self.board({1: 50, 2: 80})
+        with mock.patch.object(board, 'changed') as changed, \
+                mock.patch.object(board, '_read_names', mock.AsyncMock(return_value={3: 'newcomer'})) as read_names:
+            await board.record({1: 40, 3: 5})
+            changed.assert_called_once()
+            read_names.assert_awaited_once_with([3])
+            self.assertEqual(board.rank(1), (1, 90))
+            self.assertEqual(board.top(3)[2], {'rank': 3, 'username': 'newcomer', 'score': 5})
+
+    async def test_record_does_not_push_when_the_top_stands(self):
+        board = self.board({user_id: 100 - user_id for user_id in range(1, PUSH_SIZE + 1)})
+        board.set(PUSH_SIZE + 1, 0, 'trailing')
+        with mock.patch.object(board, 'changed') as changed:
+            await board.record({PUSH_SIZE + 1: 1})
+        changed.assert_not_called()
+        self.assertEqual(board.rank(PUSH_SIZE + 1), (PUSH_SIZE + 1, 1))
+
+    async def test_pushes_go_to_this_workers_group(self):
+        board = self.board({1: 50})
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        with override_settings(GAME_WORKER_ID='worker-a'), \
+                mock.patch('game.leaderboard.get_channel_layer', return_value=layer), \
+                mock.patch('game.leaderboard.PUSH_INTERVAL', 0):
+            await board._push()
+        layer.group_send.assert_awaited_once_with(
+            'leaderboard.worker-a', {'type': 'leaderboard_update', 'top': board.top(PUSH_SIZE)})
+
+
+@override_settings(GAME_DB_WRITER=False)
+class ConsumerTests(TransactionTestCase):
+    async def connect(self, mode='json', room=None):
+        # A room per test, as rooms outlive the test's database
+        room = room or f'test-{uuid.uuid4().hex}'
+        client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/game/{room}/?mode={mode}')
+        client.scope['user'] = AnonymousUser()
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        return client
+
+    async def reply(self, client):
+        output = await client.receive_output(timeout=5)
+        if 'bytes' in output:
+            return decode_binary(output['bytes'])
+        return json.loads(output['text'])
+
+    async def test_unreadable_messages_are_rejected_as_illegal(self):
+        client = await self.connect()
+        await self.reply(client)
+        for text, seq in (('not json', None), ('[1, 2]', None), ('{"x1": "a", "y1": 0, "x2": 1, "y2": 0, "seq": 4}', 4)):
+            await client.send_to(text_data=text)
+            reply = await self.reply(client)
+            with self.subTest(text=text):
+                self.assertTrue(reply['rejected'])
+                self.assertEqual(reply['reason'], 'illegal')
+                self.assertEqual(reply.get('seq'), seq)
+        await client.disconnect()
+
+    async def test_truncated_binary_frames_are_rejected_as_illegal(self):
+        client = await self.connect('binary')
+        await self.reply(client)
+        await client.send_to(bytes_data=b'\x01\x02')
+        reply = await self.reply(client)
+        self.assertEqual((reply['reason'], reply.get('seq')), ('illegal', None))
+        # A whole frame that isn't a legal move still has its seq echoed
+        await client.send_to(bytes_data=encode_client_move(0, 0, 0, 0, 9))
+        reply = await self.reply(client)
+        self.assertEqual((reply['reason'], reply['seq']), ('illegal', 9))
+        await client.disconnect()
+
+    async def test_moves_on_an_old_version_are_rejected_as_stale(self):
+        client = await self.connect()
+        snapshot = await self.reply(client)
+        version = snapshot['version']
+        x1, y1, x2, y2 = snapshot['hint']
+        await client.send_to(text_data=json.dumps({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'seq': 1, 'v': version}))
+        moved = await self.reply(client)
+        self.assertNotIn('rejected', moved)
+        self.assertEqual((moved['version'], moved['seq']), (version + 1, 1))
+        x1, y1, x2, y2 = moved['hint']
+        await client.send_to(text_data=json.dumps({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'seq': 2, 'v': version}))
+        reply = await self.reply(client)
+        self.assertEqual((reply['reason'], reply['seq']), ('stale', 2))
+        await client.disconnect()
+
+    async def test_bursts_over_the_limit_are_rejected_as_rate_limited(self):
+        client = await self.connect()
+        await self.reply(client)
+        count = consumers.MESSAGE_BURST + 5
+        for seq in range(count):
+            await client.send_to(text_data=json.dumps({'x1': 0, 'y1': 0, 'x2': 0, 'y2': 0, 'seq': seq}))
+        replies = [await self.reply(client) for _ in range(count)]
+        self.assertEqual([reply['seq'] for reply in replies], list(range(count)))
+        reasons = [reply['reason'] for reply in replies]
+        self.assertEqual(reasons[:consumers.MESSAGE_BURST], ['illegal'] * consumers.MESSAGE_BURST)
+        self.assertEqual(reasons[-1], 'rate_limited')
+        await client.disconnect()
+
+    async def play(self, room):
+        # A move by someone other than the test's clients, straight on the room
+        a, b = room.board.hint()
+        w = room.board.width
+        await play_move(room, a % w, a // w, b % w, b // w, 'elsewhere', 'json')
+
+    async def test_a_ticks_moves_reach_spectators_as_one_frame(self):
+        name = f'test-{uuid.uuid4().hex}'
+        client = await self.connect('binary', name)
+        snapshot = await self.reply(client)
+        room = rooms.rooms[name]
+        # Both land before the room's next tick
+        await self.play(room)
+        await self.play(room)
+        frame = await self.reply(client)
+        self.assertEqual((frame['base'], frame['v']), (snapshot['v'], snapshot['v'] + 2))
+        self.assertNotIn('swap', frame)
+        cells = snapshot['cells']
+        for k in range(0, len(frame['d']), 2):
+            cells[frame['d'][k]] = frame['d'][k + 1]
+        self.assertEqual(cells, list(room.board.cells))
+        self.assertTrue(await client.receive_nothing())
+        await client.disconnect()
+
+    async def test_clients_behind_on_acknowledgements_get_one_snapshot(self):
+        name = f'test-{uuid.uuid4().hex}'
+        client = await self.connect('json', name)
+        start = (await self.reply(client))['version']
+        room = rooms.rooms[name]
+        lag = next(entry for entry in consumers.client_lag.values() if entry['room'] == name)
+        for n in range(1, consumers.MAX_BACKLOG + 1):
+            await self.play(room)
+            self.assertEqual((await self.reply(client))['version'], start + n)
+        # One version more than the client has acknowledged is too many: a
+        # snapshot replaces the move, and later moves wait until it is applied
+        await self.play(room)
+        snapshot = await self.reply(client)
+        self.assertNotIn('swap', snapshot)
+        self.assertEqual(snapshot['version'], start + consumers.MAX_BACKLOG + 1)
+        for _ in range(2):
+            await self.play(room)
+            self.assertTrue(await client.receive_nothing())
+        self.assertEqual(lag['lag'], consumers.MAX_BACKLOG + 3)
+        self.assertEqual(lag['dropped'], 3)
+        # Applying the snapshot brings one more, as the room moved meanwhile
+        await client.send_to(text_data=json.dumps({'type': 'ack', 'v': snapshot['version']}))
+        caught_up = await self.reply(client)
+        self.assertNotIn('swap', caught_up)
+        self.assertEqual(caught_up['version'], room.version)
+        await client.send_to(text_data=json.dumps({'type': 'ack', 'v': caught_up['version']}))
+        await self.play(room)
+        self.assertEqual((await self.reply(client))['version'], caught_up['version'] + 1)
+        self.assertEqual(lag['lag'], 1)
+        await client.disconnect()
+
+
+class DBWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='writer')
+        GamePlayer.objects.create(user=self.user)
+
+    async def test_a_failing_job_does_not_take_its_batch_down(self):
+        writer = DBWriter()
+        started = threading.Event()
+        gate = threading.Event()
+        batches = []
+        commit = writer._commit
+
+        def record(batch):
+            batches.append(len(batch))
+            return commit(batch)
+
+        def hold():
+            started.set()
+            return gate.wait(5)
+
+        def fail():
+            GamePlayer.add_score(self.user.id, 1000)
+            raise ValueError("bad job")
+
+        with mock.patch.object(writer, '_commit', record):
+            # The first job holds the writer until the other two are queued,
+            # so they are committed together
+            held = writer.submit(hold)
+            await asyncio.to_thread(started.wait, 5)
+            good = writer.submit(GamePlayer.add_score, self.user.id, 7)
+            bad = writer.submit(fail)
+            gate.set()
+            results = await asyncio.gather(held, good, bad, return_exceptions=True)
+        self.assertEqual(batches, [1, 2])
+        self.assertIs(results[0], True)
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual((await GamePlayer.objects.aget(user=self.user)).score, 7)
+
+
+class CachedAuthTests(TransactionTestCase):
+    def setUp(self):
+        auth._users.clear()
+        self.user = User.objects.create_user(username='player', password='first password')
+        session = SessionStore()
+        session[SESSION_KEY] = str(self.user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = self.user.get_session_auth_hash()
+        session.create()
+        self.key = session.session_key
+
+    async def resolve(self):
+        scope = {'session': SessionStore(self.key), 'user': UserLazyObject()}
+        await auth.CachedAuthMiddleware(None).resolve_scope(scope)
+        return scope['user']._wrapped
+
+    async def test_signed_in_users_are_cached(self):
+        self.assertEqual((await self.resolve()).pk, self.user.pk)
+        self.assertIn(self.key, auth._users)
+        with mock.patch.object(User.objects, 'get', side_effect=AssertionError("read the user")):
+            self.assertEqual((await self.resolve()).pk, self.user.pk)
+
+    async def test_a_session_ended_elsewhere_is_seen_at_once(self):
+        await self.resolve()
+        await SessionStore(self.key).adelete()
+        self.assertFalse((await self.resolve()).is_authenticated)
+        self.assertNotIn(self.key, auth._users)
+
+    async def test_a_password_change_ends_cached_sessions(self):
+        await self.resolve()
+        self.user.set_password('second password')
+        await self.user.asave()
+        self.assertNotIn(self.key, auth._users)
+        self.assertFalse((await self.resolve()).is_authenticated)
@@ -1,14 +1,15 @@
-from django.urls import path
+from django.urls import path, re_path
 from game import views
-from game.consumers import GameConsumer
+from game.routing import ROOM_ID, websocket_urlpatterns
 
 urlpatterns = [
     path('', views.index, name='game_home'),
+    path('rooms/', views.room_list, name='room_list'),
+    path('leaderboard/', views.leaderboard_view, name='leaderboard'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('rooms/new/', views.create_room, name='create_room'),
+    re_path(rf'^rooms/{ROOM_ID}/$', views.room_view, name='room'),
     path('signup/', views.signup_view, name='signup'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     ]
-
-websocket_urlpatterns = [
-    path('ws/game/', GameConsumer.as_asgi()),
-]
\ No newline at end of file
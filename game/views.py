@@ -3,7 +3,10 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from game.leaderboard import leaderboard
+from game.metrics import metrics
+from game.rooms import BOARD_PRESETS, client_lag, new_room_name, rooms
 
 def signup_view(request):
     if request.method == "POST":
@@ -40,5 +43,65 @@ def logout_view(request):
 
 #@login_required
 def index(request):
-    return render(request, "game/index.html", {"username": request.user.username})
+    return render(request, "game/index.html", {"username": request.user.username, "board_presets": BOARD_PRESETS})
 
+def room_view(request, room_id):
+    return render(request, "game/index.html", {
+        "username": request.user.username, "room_id": room_id, "board_presets": BOARD_PRESETS,
+    })
+
+def create_room(request):
+    # ?board= picks one of the room board presets
+    return redirect("room", room_id=new_room_name(request.GET.get("board")))
+
+def room_list(request):
+    # Rooms live in this process while anyone is connected to them and for a
+    # short while after; lag covers the connections this process serves, in
+    # versions past the latest each client acknowledged
+    lag = {}
+    for client in list(client_lag.values()):
+        lag.setdefault(client["room"], []).append(client)
+    return JsonResponse({
+        "rooms": [
+            {
+                "room_id": room.name,
+                "clients": room.clients,
+                "version": room.version,
+                "board": [room.board.width, room.board.height, room.board.kinds],
+                "lag": [
+                    {"lag": c["lag"], "max_lag": c["max_lag"], "dropped": c["dropped"]}
+                    for c in lag.get(room.name, [])
+                ],
+            }
+            for room in list(rooms.rooms.values())
+        ]
+    })
+
+
+async def leaderboard_view(request):
+    # Served from the in-memory leaderboard; ?n= picks how many of the top to list
+    await leaderboard.ready()
+    try:
+        n = max(1, min(int(request.GET.get("n", 10)), 100))
+    except ValueError:
+        n = 10
+    data = {"top": leaderboard.top(n)}
+    user = await request.auser()
+    if user.is_authenticated:
+        rank, score = leaderboard.rank(user.id)
+        data["me"] = {"rank": rank, "username": user.username, "score": score}
+    return JsonResponse(data)
+
+
+def metrics_view(request):
+    if not metrics.enabled:
+        raise Http404("Metrics are disabled")
+    live = list(rooms.rooms.values())
+    gauges = [("rooms", {}, len(live)), ("connections", {}, len(client_lag))]
+    gauges += [("room_clients", {"room": room.name}, room.clients) for room in live]
+    gauges += [("room_version", {"room": room.name}, room.version) for room in live]
+    worst = {}
+    for client in list(client_lag.values()):
+        worst[client["room"]] = max(worst.get(client["room"], 0), client["lag"])
+    gauges += [("room_max_lag_versions", {"room": name}, lag) for name, lag in worst.items()]
+    return HttpResponse(metrics.render(gauges), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,161 @@
+"""A small asyncio WebSocket client (RFC 6455) for driving the server in load tests.
+
+It speaks just enough of the protocol for the game: unmasked server frames,
+masked client frames, fragmented messages, ping/pong and close.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+from urllib.parse import urlsplit
+
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class HandshakeError(Exception):
+    pass
+
+
+def _mask(payload, key):
+    n = len(payload)
+    if not n:
+        return payload
+    keys = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(keys, 'big')).to_bytes(n, 'big')
+
+
+class WebSocketClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    @classmethod
+    async def connect(cls, url, headers=None):
+        parts = urlsplit(url)
+        if parts.scheme != 'ws':
+            raise ValueError("Only ws:// URLs are supported")
+        host = parts.hostname
+        port = parts.port or 80
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        reader, writer = await asyncio.open_connection(host, port)
+
+        key = base64.b64encode(os.urandom(16))
+        lines = [
+            f'GET {path} HTTP/1.1',
+            f'Host: {host}:{port}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key.decode()}',
+            'Sec-WebSocket-Version: 13',
+        ]
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        await writer.drain()
+
+        response = await reader.readuntil(b'\r\n\r\n')
+        status, *header_lines = response.decode('latin-1').split('\r\n')
+        if ' 101 ' not in status + ' ':
+            writer.close()
+            raise HandshakeError(f"Server refused the upgrade: {status}")
+        received = {}
+        for line in header_lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                received[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(key + _GUID).digest()).decode()
+        if received.get('sec-websocket-accept') != accept:
+            writer.close()
+            raise HandshakeError("Bad Sec-WebSocket-Accept")
+        return cls(reader, writer)
+
+    async def send(self, message):
+        """Sends str as a text frame and bytes as a binary frame."""
+        if isinstance(message, str):
+            await self._send_frame(OP_TEXT, message.encode())
+        else:
+            await self._send_frame(OP_BINARY, bytes(message))
+
+    async def _send_frame(self, opcode, payload):
+        if self.closed:
+            raise ConnectionClosed()
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | n)
+        elif n < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, n)
+        key = os.urandom(4)
+        self.writer.write(header + key + _mask(payload, key))
+        await self.writer.drain()
+
+    async def recv(self):
+        """Returns the next message as str or bytes; raises ConnectionClosed at the end."""
+        chunks = []
+        message_opcode = None
+        while True:
+            try:
+                head = await self.reader.readexactly(2)
+                fin, opcode = head[0] & 0x80, head[0] & 0x0F
+                n = head[1] & 0x7F
+                if n == 126:
+                    n = struct.unpack('!H', await self.reader.readexactly(2))[0]
+                elif n == 127:
+                    n = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+                key = await self.reader.readexactly(4) if head[1] & 0x80 else None
+                payload = await self.reader.readexactly(n)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                raise ConnectionClosed()
+            if key:
+                payload = _mask(payload, key)
+
+            if opcode == OP_PING:
+                await self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                if not self.closed:
+                    await self._send_frame(OP_CLOSE, payload[:2])
+                    self.closed = True
+                self.writer.close()
+                raise ConnectionClosed()
+            if opcode != OP_CONTINUATION:
+                message_opcode = opcode
+            chunks.append(payload)
+            if fin:
+                data = b''.join(chunks)
+                return data.decode() if message_opcode == OP_TEXT else data
+
+    async def close(self, timeout=1.0):
+        """Starts the closing handshake and waits briefly for the server's close frame."""
+        if not self.closed:
+            try:
+                await self._send_frame(OP_CLOSE, struct.pack('!H', 1000))
+                self.closed = True
+                await asyncio.wait_for(self._drain(), timeout)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            self.closed = True
+        self.writer.close()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self.recv()
+        except ConnectionClosed:
+            pass